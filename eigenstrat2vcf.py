@@ -2,12 +2,19 @@
 #Writes to stdout, unlike many of these scripts. 
 #Usage: python eigenstrat2vcf.py -r root [options]
 #Data files are root.snp, root.ind and root.geno
+#The .snp file is indexed (root.snp.idx.npz, built the first time) and the .geno 
+#file memory mapped, so only the snps and individuals we want are read. 
  
 from __future__ import division, print_function
-import argparse, gdc, pyEigenstrat
+import argparse, sys, gdc
+import numpy as np
 
 #Remember, in eigenstrat, 2 means "2 ref copies"
 GT_DICT={2:"0/0", 1:"0/1", 0:"1/1", 9:"./."}
+# GT_DICT as a table of 4 byte cells, with the tab after each genotype. 
+GT_CELLS=np.zeros((10, 4), dtype=np.uint8)
+for code, gt in GT_DICT.items():
+    GT_CELLS[code]=np.frombuffer((gt+"\t").encode("ascii"), dtype=np.uint8)
 
 ################################################################################
 
@@ -24,6 +31,10 @@ def parse_options():
                         "File with populations to include, one population per line")
     parser.add_argument('-s', '--snps', type=str, default="", help=
                         "File with snps to include, one snp per line")
+    parser.add_argument('-g', '--region', type=str, default="", help=
+                        "Only include snps in this chromosome, or chrom:start-end")
+    parser.add_argument('-o', '--out', type=str, default="", help=
+                        "Output file (bgzipped if it ends in .gz), default stdout")
 
     return parser.parse_args()
 
@@ -36,27 +47,64 @@ def main(options):
 
     inds=pops=snps=None
     if(options.inds):
-        inds=[x[:-1] for x in open(options.inds) if x[:-1]]
+        inds=set([x[:-1] for x in open(options.inds) if x[:-1]])
     if(options.pops):
-        pops=[x[:-1] for x in open(options.pops) if x[:-1]]
+        pops=set([x[:-1] for x in open(options.pops) if x[:-1]])
     if(options.snps):
-        snps=[x[:-1] for x in open(options.snps) if x[:-1]]
+        snps=set([x[:-1] for x in open(options.snps) if x[:-1]])
 
-    data=pyEigenstrat.load(options.root, inds=inds, pops=pops, snps=snps)
+    snp=gdc.SnpIndex(options.root+".snp")
+    ind=gdc.read_ind(options.root+".ind")
+    geno=gdc.GenoReader(options.root+".geno", len(ind), len(snp))
+
+    #Individuals in inds or pops (or all of them), and the snps we want, in file order
+    include=[i for i, (name, sex, pop) in enumerate(ind) if (not inds and not pops) or (inds and name in inds) or (pops and pop in pops)]
+    rows=np.arange(len(snp))
+    if snps:
+        rows=snp.rows(list(snps))
+    if options.region:
+        chrom, _, interval=options.region.partition(":")
+        start, end=[int(x) for x in interval.split("-")] if interval else (None, None)
+        rows=np.intersect1d(rows, snp.region(chrom, start, end))
+
+    out=gdc.open2(options.out, "w") if options.out else sys.stdout
 
     #Write header. 
-    print("##fileformat=VCFv4.0")
-    print("##source=eigenstrat2vcf.py")
-    print("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">")
-    print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join(data.ind["IND"]))
-
-    #Now line by line write data
-    for i,d in enumerate(data):
-        this_snp=data.snp[i]
-        line="\t".join([this_snp["CHR"], str(this_snp["POS"]), this_snp["ID"], 
-                         this_snp["REF"], this_snp["ALT"], "100", "PASS", ".", "GT" ])
-        line=line+"\t"+"\t".join([GT_DICT[x] for x in d])
-        print(line)
+    out.write("##fileformat=VCFv4.0\n")
+    out.write("##source=eigenstrat2vcf.py\n")
+    out.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n")
+    out.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join([ind[i][0] for i in include])+"\n")
+
+    #Now write data a block of snps at a time
+    for start in range(0, len(rows), gdc.CHUNK_SIZE):
+        block=rows[start:start+gdc.CHUNK_SIZE]
+        snps=dict((column, getattr(snp, column)[block]) for column in ["CHR", "POS", "ID", "REF", "ALT"])
+        out.write(vcf_lines(snps, geno.read(block, include)))
+
+    if options.out:
+        out.close()
+
+################################################################################
+
+def vcf_lines(snps, genos):
+    """
+    The vcf lines for a block of snps (a dictionary of CHR, POS, ID, REF and 
+    ALT arrays) and their nsnp x nind genotypes, as one string. 
+    """
+    known=np.isin(genos, list(GT_DICT.keys()))
+    if not known.all():
+        raise Exception("Unknown genotype "+str(genos[~known][0]))
+    nind=genos.shape[1]
+    cells=GT_CELLS[genos]
+    if nind:
+        cells[:,-1,3]=ord("\n")
+        gt_strings=cells.reshape(len(genos), 4*nind).view("S"+str(4*nind)).ravel().astype(str).tolist()
+    else:
+        gt_strings=["\n"]*len(genos)
+    
+    return "".join(["\t".join([chrom, str(pos), idd, ref, alt, "100", "PASS", ".", "GT", gts]) for chrom, pos, idd, ref, alt, gts in 
+                    zip(snps["CHR"].tolist(), snps["POS"].tolist(), snps["ID"].tolist(), snps["REF"].tolist(), 
+                        snps["ALT"].tolist(), gt_strings)])
         
 ################################################################################
 
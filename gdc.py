@@ -1,25 +1,839 @@
 # Shared functions
-import gzip, pdb
+from __future__ import division
+import gzip, mmap, operator, os, shutil, struct, threading, zlib, pdb
+from multiprocessing.pool import ThreadPool
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import pysam
+except ImportError:
+    pysam=None
+try:
+    from pyfaidx import Fasta
+except ImportError:
+    Fasta=None
+
+# Threads used by open2 to decompress gzipped input. 0 reads in the main thread.
+READ_THREADS=4
+# BGZF blocks decompressed together, and batches of lines held in the queue.
+READ_BLOCKS=64
+READ_QUEUE=8
+# Threads shared by all gzipped outputs of open2, the most blocks one output 
+# compresses together, and the bytes all outputs together buffer for compression
+WRITE_THREADS=4
+WRITE_BLOCKS=64
+WRITE_BUFFER=64*1024*1024
+COMPRESS_LEVEL=6
+
+# Largest uncompressed BGZF block, as in htslib, and the empty block that marks the end
+BGZF_BLOCK_SIZE=0xff00
+BGZF_EOF=b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# psmcfa bin size and line length, as in fq2psmcfa
+PSMCFA_BIN=100
+PSMCFA_WRAP=60
+
+# Number of vcf records returned at once by VCFReader
+CHUNK_SIZE=10000
+
+# Allele indices in VCFReader genotype arrays. Alleles 0-9 are decoded, 
+# anything else is missing. The second allele of a haploid call is HAPLOID. 
+MISSING=-1
+HAPLOID=-2
+ALLELE_INDEX=np.full(256, MISSING, dtype=np.int8)
+ALLELE_INDEX[ord("0"):ord("9")+1]=np.arange(10)
+
+# Run-length mask index cached next to mask fastas, and the bases read at once 
+# when building it. Mask levels are the digits 0-9, anything else is -1.
+MASK_INDEX_SUFFIX=".rle.npz"
+MASK_INDEX_WINDOW=10000000
+MASK_LEVEL=np.full(256, -1, dtype=np.int8)
+MASK_LEVEL[ord("0"):ord("9")+1]=np.arange(10)
+
+# Index of eigenstrat .snp files, cached next to them
+SNP_INDEX_SUFFIX=".idx.npz"
+
+# Columns of the site table of population allele counts
+SITE_COLS=["SNPID", "CHR", "POS", "REF", "ALT"]
 
 ################################################################################
 
-def open2(file, mode="r"):
+def open2(file, mode="r", threads=None):
 	"""
-	Open a file, or a gzipped file if it ends in .gz
+	Open a file, or a gzipped file if it ends in .gz. Gzipped files opened 
+	for reading are decompressed in background threads, and gzipped files 
+	opened for writing are written as BGZF, compressed on a pool of threads,
+	unless threads is 0.
 	"""
-	if file[-3:]==".gz":
+	if threads is None:
+		threads=READ_THREADS if mode[0]=="r" else WRITE_THREADS
+	if file[-3:]==".gz" and mode[0]=="r" and threads:
+		return PipelinedReader(file, threads)
+	elif file[-3:]==".gz" and mode[0]=="w" and threads:
+		return BgzfWriter(file, threads)
+	elif file[-3:]==".gz":
 		return gzip.open(file, mode)
 	else:
 		return open(file, mode)
 
 ################################################################################
 
+class PipelinedReader(object):
+    """
+    Iterate over the lines of a gzipped file, which are decompressed and split
+    in a background thread and handed over in batches through a bounded queue.
+    BGZF files (e.g. from bgzip) are decompressed a batch of blocks at a time
+    on a pool of threads. 
+    """
+    def __init__(self, file, threads=READ_THREADS):
+        self.queue=queue.Queue(READ_QUEUE)
+        self.lines=iter([])
+        self.closed=False
+        self.thread=threading.Thread(target=self.produce, args=(file, threads))
+        self.thread.daemon=True
+        self.thread.start()
+
+    def produce(self, file, threads):
+        """
+        Runs in the background thread: decompress, split and queue lines.
+        """
+        try:
+            raw=open(file, "rb")
+            if is_bgzf(raw):
+                data=read_bgzf(raw, threads)
+            else:
+                raw.close()
+                raw=gzip.open(file, "rb")
+                data=iter(lambda:raw.read(READ_BLOCKS*65536), b"")
+
+            leftover=b""
+            for buf in data:
+                lines=(leftover+buf).splitlines(True)
+                leftover=b""
+                if lines and not lines[-1].endswith(b"\n"):
+                    leftover=lines.pop()
+                if lines and not self.put(lines):
+                    break
+            if leftover:
+                self.put([leftover])
+            raw.close()
+            self.put(None)
+        except Exception as err:
+            self.put(err)
+
+    def put(self, item):
+        """
+        Queue item, giving up if the reader is closed. 
+        """
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            try:
+                return next(self.lines)
+            except StopIteration:
+                if self.closed:
+                    raise
+                batch=self.queue.get()
+                if batch is None:
+                    self.closed=True
+                    raise StopIteration
+                elif isinstance(batch, Exception):
+                    self.closed=True
+                    raise batch
+                self.lines=iter(batch)
+
+    __next__=next
+
+    def readline(self):
+        try:
+            return next(self)
+        except StopIteration:
+            return b""
+
+    def close(self):
+        self.closed=True
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+################################################################################
+
+def is_bgzf(raw):
+    """
+    Check whether a file starts with a BGZF block, and rewind it. 
+    """
+    header=raw.read(16)
+    raw.seek(0)
+    return len(header)==16 and header[:4]==b"\x1f\x8b\x08\x04" and header[12:14]==b"BC"
+
+################################################################################
+
+def read_bgzf(raw, threads):
+    """
+    Generate the decompressed contents of a BGZF file, READ_BLOCKS blocks at a
+    time, decompressing the blocks in each batch in parallel.
+    """
+    pool=ThreadPool(threads)
+    try:
+        while True:
+            blocks=[]
+            while len(blocks)<READ_BLOCKS:
+                header=raw.read(12)
+                if not header:
+                    break
+                xlen=struct.unpack("<H", header[10:12])[0]
+                extra=raw.read(xlen)
+                bsize=None
+                i=0
+                while i<xlen:
+                    slen=struct.unpack("<H", extra[i+2:i+4])[0]
+                    if extra[i:i+2]==b"BC":
+                        bsize=struct.unpack("<H", extra[i+4:i+6])[0]
+                    i+=4+slen
+                if bsize is None:
+                    raise Exception("Missing BGZF block size")
+                blocks.append(raw.read(bsize-xlen-19))
+                raw.read(8)                 # CRC and uncompressed size
+            if not blocks:
+                break
+            yield b"".join(pool.map(inflate, blocks))
+    finally:
+        pool.close()
+
+################################################################################
+
+def inflate(data):
+    """
+    Decompress raw deflate data, as in the body of a gzip member. 
+    """
+    return zlib.decompress(data, -15)
+
+################################################################################
+
+class BgzfWriter(object):
+    """
+    Write a BGZF file, which is a valid gzip file that can also be indexed 
+    by tabix or samtools faidx. Writes are buffered and batches of blocks are
+    compressed together on a pool of threads, while the next batch is filled. 
+    All the writers in a process share one pool of threads (created with 
+    threads threads), and the batches shrink as more writers are open so 
+    that together they buffer about WRITE_BUFFER bytes, but always at least
+    one block each. 
+    """
+    pool=None
+    pool_pid=None
+    open_writers=0
+
+    def __init__(self, file, threads=WRITE_THREADS, level=COMPRESS_LEVEL):
+        self.file=open(file, "wb")
+        #A pool inherited from the parent of a worker process has no threads
+        if BgzfWriter.pool_pid!=os.getpid():
+            BgzfWriter.pool=ThreadPool(threads)
+            BgzfWriter.pool_pid=os.getpid()
+        BgzfWriter.open_writers+=1
+        self.level=level
+        self.buffer=[]
+        self.buffer_len=0
+        self.pending=None
+
+    def batch_size(self):
+        """
+        Bytes to buffer before compressing, and the most compressed bytes 
+        left pending between writes: these of every open writer fit in 
+        WRITE_BUFFER. 
+        """
+        blocks=WRITE_BUFFER//(2*BGZF_BLOCK_SIZE*BgzfWriter.open_writers)
+        return max(1, min(WRITE_BLOCKS, blocks))*BGZF_BLOCK_SIZE
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_len+=len(data)
+        if self.buffer_len>=self.batch_size():
+            self.flush_blocks()
+
+    def flush_blocks(self):
+        """
+        Start compressing the buffered data, after writing the last batch. 
+        """
+        data=b"".join(self.buffer)
+        self.buffer=[]
+        self.buffer_len=0
+        #Large writes are compressed in batches big enough to use every thread,
+        #and a batch bigger than batch_size is not left pending
+        batch=self.batch_size()
+        step=max(batch, WRITE_THREADS*BGZF_BLOCK_SIZE)
+        for start in range(0, len(data), step):
+            self.write_pending()
+            blocks=[data[i:i+BGZF_BLOCK_SIZE] for i in range(start, min(len(data), start+step), BGZF_BLOCK_SIZE)]
+            self.pending=BgzfWriter.pool.map_async(self.compress, blocks)
+        if len(data)-start>batch:
+            self.write_pending()
+
+    def write_pending(self):
+        if self.pending:
+            self.file.write(b"".join(self.pending.get()))
+            self.pending=None
+
+    def compress(self, block):
+        """
+        Compress one block and add the BGZF header and gzip trailer. 
+        """
+        deflate=zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata=deflate.compress(block)+deflate.flush()
+        header=struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata)+25)
+        trailer=struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block))
+        return header+cdata+trailer
+
+    def close(self):
+        if self.buffer_len:
+            self.flush_blocks()
+        self.write_pending()
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        BgzfWriter.open_writers-=1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+################################################################################
+
+def tabix_contigs(file):
+    """
+    List the sequences in a bgzipped, tabix indexed file, in index order.
+    """
+    if not pysam:
+        raise Exception("Reading tabix indexed files needs pysam")
+    return list(pysam.TabixFile(file).contigs)
+
+################################################################################
+
+def tabix_fetch(file, region):
+    """
+    Iterate over the lines of a bgzipped, tabix indexed file in a region
+    (a chromosome, or chrom:start-end). 
+    """
+    if not pysam:
+        raise Exception("Reading tabix indexed files needs pysam")
+    tbx=pysam.TabixFile(file)
+    if region.split(":")[0] in tbx.contigs:
+        for line in tbx.fetch(region):
+            yield line+"\n"
+    tbx.close()
+
+################################################################################
+
+class VCFReader(object):
+    """
+    Read a vcf in chunks of records. The header is read when the reader is
+    created, and only the sample columns listed in samples (default all) are 
+    parsed. region is either a chromosome or chrom:start-end. If the vcf is 
+    tabix indexed we seek to it, otherwise records on other chromosomes are 
+    skipped (which only works for whole chromosomes). 
+
+    Iterating gives a dictionary for each chunk with arrays CHROM, POS, ID, 
+    REF and ALT, GT, an nsite x nsample x 2 array of allele indices (MISSING 
+    for missing and HAPLOID for the second allele of a haploid call) and 
+    PHASED, True where the genotype is diploid and phased, and UNKNOWN, True
+    where the entry is neither haploid nor diploid (these are MISSING in GT). 
+    blocks() gives the unparsed lines of each chunk instead, for 
+    parse_records. 
+    """
+    def __init__(self, vcf, samples=None, region=None, chunk_size=CHUNK_SIZE):
+        self.lines=open2(vcf) if isinstance(vcf, str) else vcf
+        self.chunk_size=chunk_size
+        self.prefix=None
+        for line in self.lines:
+            if line[:6]=="#CHROM":
+                self.samples=line.split()[9:]
+                break
+
+        self.header_samples=self.samples
+        if samples is None:
+            self.sample_idx=list(range(9, 9+len(self.samples)))
+        else:
+            self.select(samples)
+
+        if region and isinstance(vcf, str) and (os.path.exists(vcf+".tbi") or os.path.exists(vcf+".csi")):
+            self.lines.close()
+            self.lines=tabix_fetch(vcf, region)
+        elif region and ":" in region:
+            raise Exception("Reading a region needs a tabix indexed vcf")
+        elif region:
+            self.prefix=region+"\t"
+
+    def select(self, samples):
+        """
+        Only parse the columns of these samples, which must not be repeated 
+        in the header. 
+        """
+        columns={}
+        for i, x in enumerate(self.header_samples):
+            columns.setdefault(x, []).append(9+i)
+        for x in samples:
+            if x not in columns:
+                raise Exception("Sample "+x+" not in vcf")
+            if len(columns[x])>1:
+                raise Exception("Sample "+x+" appears more than once in the vcf header")
+        self.sample_idx=[columns[x][0] for x in samples]
+        self.samples=list(samples)
+
+    def blocks(self):
+        """
+        Generate lists of up to chunk_size unparsed record lines.
+        """
+        block=[]
+        for line in self.lines:
+            if line[:1]=="#" or (self.prefix and not line.startswith(self.prefix)):
+                continue
+            block.append(line)
+            if len(block)==self.chunk_size:
+                yield block
+                block=[]
+        if block:
+            yield block
+
+    def __iter__(self):
+        for block in self.blocks():
+            yield parse_records(block, self.sample_idx)
+
+    def close(self):
+        if hasattr(self.lines, "close"):
+            self.lines.close()
+
+################################################################################
+
+def parse_records(lines, sample_idx):
+    """
+    Parse a list of vcf record lines into a VCFReader chunk, with the sample
+    columns in sample_idx (counting from 0, so the first sample is 9). 
+    """
+    # Only split as far as the last sample we need
+    maxsplit=max([4]+sample_idx)+1
+    if len(sample_idx)==1:
+        get_samples=lambda bits:(bits[sample_idx[0]],)
+    elif len(sample_idx):
+        get_samples=operator.itemgetter(*sample_idx)
+    else:
+        get_samples=lambda bits:()
+
+    fixed=[]
+    gts=[]
+    for line in lines:
+        bits=line.split(None, maxsplit)
+        fixed.append(bits[:5])
+        gts.extend(get_samples(bits))
+
+    chunk=dict(zip(["CHROM", "POS", "ID", "REF", "ALT"], [np.array(x) for x in zip(*fixed)]))
+    chunk["POS"]=chunk["POS"].astype(int)
+    chunk["GT"], chunk["PHASED"], chunk["UNKNOWN"]=decode_gts(gts, len(fixed))
+    return chunk
+
+################################################################################
+
+def decode_gts(gts, nsites):
+    """
+    Decode a list of vcf genotype entries for nsites sites into an nsites x 
+    nsamples x 2 array of allele indices, an array saying which are phased and
+    an array saying which are neither haploid nor diploid (e.g. 0/0/1). 
+    """
+    # The first four bytes are enough to tell "0", "0:..", "0/1" and "0/1:.."
+    # apart. Shorter entries are padded with zeros.
+    gt=np.array(gts, dtype="S4").view(np.uint8).reshape(nsites, len(gts)//nsites, 4)
+    end=(gt==0)|(gt==ord(":"))
+    haploid=~end[:,:,0]&end[:,:,1]
+    diploid=~end[:,:,0]&~end[:,:,1]&~end[:,:,2]&end[:,:,3]
+
+    alleles=np.full(gt.shape[:2]+(2,), MISSING, dtype=np.int8)
+    alleles[:,:,0]=np.where(haploid|diploid, ALLELE_INDEX[gt[:,:,0]], MISSING)
+    alleles[:,:,1]=np.where(diploid, ALLELE_INDEX[gt[:,:,2]], MISSING)
+    alleles[:,:,1][haploid]=HAPLOID
+    phased=diploid&(gt[:,:,1]==ord("|"))
+    return alleles, phased, ~(haploid|diploid)
+
+################################################################################
+
+def read_fai(file):
+    """
+    Read the .fai index of a fasta file, building it with pyfaidx if it does not
+    exist. Returns a list of (name, length, offset, line bases, line width) in 
+    file order. 
+    """
+    if not os.path.exists(file+".fai"):
+        if not Fasta:
+            raise Exception("No index for "+file+" and no pyfaidx to build one")
+        Fasta(file)
+    fai=[]
+    for line in open(file+".fai"):
+        bits=line.split()
+        fai.append((bits[0],)+tuple(int(x) for x in bits[1:5]))
+    return fai
+
+################################################################################
+
+def is_compressed(file):
+    """
+    Whether a file is gzipped or bgzipped, from its magic bytes.
+    """
+    with open(file, "rb") as f:
+        return f.read(2)==b"\x1f\x8b"
+
+################################################################################
+
+def faidx_record(file, chrom):
+    """
+    A pyfaidx record for one sequence of a compressed fasta file, which we 
+    cannot memory map. pyfaidx needs Biopython to read bgzipped files. 
+    """
+    if not Fasta:
+        raise Exception("Need pyfaidx to read compressed fasta "+file)
+    fasta=Fasta(file, as_raw=True)
+    if chrom not in fasta:
+        raise Exception("Chromosome "+chrom+" not in "+file)
+    return fasta[chrom]
+
+################################################################################
+
+def load_fasta(file, chrom):
+    """
+    Load one sequence from an indexed fasta file into an array of bytes. 
+    Uncompressed files are memory mapped and the line ends dropped, bgzipped
+    ones are read with pyfaidx. 
+    """
+    index=dict((x[0], x[1:]) for x in read_fai(file))
+    if chrom not in index:
+        raise Exception("Chromosome "+chrom+" not in "+file)
+    if is_compressed(file):
+        return np.frombuffer(bytearray(faidx_record(file, chrom)[:].encode("ascii")), dtype=np.uint8)
+    length, offset, line_bases, line_width=index[chrom]
+    nlines=length//line_bases
+
+    fa=open(file, "rb")
+    data=mmap.mmap(fa.fileno(), 0, access=mmap.ACCESS_READ)
+    lines=np.frombuffer(data, dtype=np.uint8, count=nlines*line_width, offset=offset)
+    tail=np.frombuffer(data, dtype=np.uint8, count=length-nlines*line_bases, offset=offset+nlines*line_width)
+    seq=np.concatenate([lines.reshape(nlines, line_width)[:,:line_bases].ravel(), tail])
+    del lines, tail
+    data.close()
+    fa.close()
+    return seq
+
+################################################################################
+
+def fasta_windows(file, chrom, window):
+    """
+    Generate one sequence from an indexed fasta file in windows of window 
+    bases, as byte arrays. Only one window is in memory at a time. Bgzipped 
+    files are read with pyfaidx. 
+    """
+    index=dict((x[0], x[1:]) for x in read_fai(file))
+    if chrom not in index:
+        raise Exception("Chromosome "+chrom+" not in "+file)
+    length, offset, line_bases, line_width=index[chrom]
+    if is_compressed(file):
+        record=faidx_record(file, chrom)
+        for start in range(0, length, window):
+            yield np.frombuffer(bytearray(record[start:min(length, start+window)].encode("ascii")), dtype=np.uint8)
+        return
+
+    fa=open(file, "rb")
+    data=mmap.mmap(fa.fileno(), 0, access=mmap.ACCESS_READ)
+    for start in range(0, length, window):
+        end=min(length, start+window)
+        first=offset+(start//line_bases)*line_width+start%line_bases
+        last=offset+((end-1)//line_bases)*line_width+(end-1)%line_bases+1
+        raw=np.frombuffer(data[first:last], dtype=np.uint8)
+        yield raw[(raw!=ord("\n"))&(raw!=ord("\r"))]
+    data.close()
+    fa.close()
+
+################################################################################
+
+def fasta_stream(file, window):
+    """
+    Read a fasta file, gzipped or not, from start to end and generate 
+    (chromosome, sequence) pairs, where the sequence is a byte array of the 
+    next window bases of the chromosome (less at the end of it). The file is
+    read in blocks of window bytes whatever its line length, so only about 
+    two windows are in memory at a time. 
+    """
+    fa=open2(file, "rb", threads=0)
+    chrom=None
+    header=None
+    pieces=[]
+    size=0
+    while True:
+        data=fa.read(window)
+        if not data:
+            break
+        pos=0
+        while pos<len(data):
+            if header is not None:
+                #Inside a header line, which may span blocks
+                end=data.find(b"\n", pos)
+                header+=data[pos:] if end<0 else data[pos:end]
+                if end<0:
+                    break
+                chrom=header[1:].split()[0]
+                if not isinstance(chrom, str):
+                    chrom=chrom.decode("ascii")
+                header=None
+                pos=end+1
+                continue
+            end=data.find(b">", pos)
+            seq=(data[pos:] if end<0 else data[pos:end]).translate(None, b" \t\r\n")
+            pieces.append(seq)
+            size+=len(seq)
+            if size>=window:
+                seq=b"".join(pieces)
+                for start in range(0, size-size%window, window):
+                    yield chrom, np.frombuffer(seq[start:start+window], dtype=np.uint8)
+                pieces=[seq[size-size%window:]]
+                size=size%window
+            if end<0:
+                break
+            if size:
+                yield chrom, np.frombuffer(b"".join(pieces), dtype=np.uint8)
+            pieces=[]
+            size=0
+            header=b""
+            pos=end
+    if size:
+        yield chrom, np.frombuffer(b"".join(pieces), dtype=np.uint8)
+    fa.close()
+
+################################################################################
+
+def wrap_seq(seq, width):
+    """
+    Wrap a byte array of sequence into lines of width, each ending in a newline.
+    """
+    nlines=len(seq)//width
+    lines=np.empty((nlines, width+1), dtype=np.uint8)
+    lines[:,:width]=seq[:nlines*width].reshape(nlines, width)
+    lines[:,width]=ord("\n")
+    wrapped=lines.tobytes()
+    if len(seq)>nlines*width:
+        wrapped+=seq[nlines*width:].tobytes()+b"\n"
+    return wrapped
+
+################################################################################
+
+class MaskRuns(object):
+    """
+    One sequence of a mask fasta as runs of the same byte: starts of the runs 
+    (0-based) and their values. Queries are binary searches on the starts. 
+    """
+    def __init__(self, starts, values, length):
+        self.starts=starts
+        self.values=values
+        self.length=length
+
+    def __len__(self):
+        return self.length
+
+    def at(self, pos):
+        """
+        Mask bytes at 0-based positions (a number or an array). 
+        """
+        return self.values[np.searchsorted(self.starts, pos, side="right")-1]
+
+    def at_least(self, pos, level):
+        """
+        Whether the mask is at least level at 0-based positions. 
+        """
+        return MASK_LEVEL[self.at(pos)]>=level
+
+    def masked_intervals(self, start, end, level):
+        """
+        List of the (start, end) intervals in [start, end) that are below level. 
+        """
+        first=np.searchsorted(self.starts, start, side="right")-1
+        last=np.searchsorted(self.starts, end, side="left")
+        starts=np.clip(self.starts[first:last], start, end)
+        ends=np.clip(np.append(self.starts[first+1:last], end), start, end)
+        below=MASK_LEVEL[self.values[first:last]]<level
+        #Adjacent runs below the level make one interval
+        edges=np.diff(np.concatenate([[0], below.astype(np.int8), [0]]))
+        return list(zip(starts[edges[:-1]==1].tolist(), ends[edges[1:]==-1].tolist()))
+
+################################################################################
+
+class MaskIndex(object):
+    """
+    Run-length index of a mask fasta, cached in file+MASK_INDEX_SUFFIX and 
+    rebuilt if the mask's size or modification time changes. index[chrom] is 
+    a MaskRuns, loaded when it's first used. 
+    """
+    def __init__(self, file):
+        self.file=file
+        self.runs={}
+        stat=os.stat(file)
+        self.stamp=np.array([stat.st_size, stat.st_mtime])
+        cache=file+MASK_INDEX_SUFFIX
+        if os.path.exists(cache):
+            self.data=np.load(cache)
+            if np.array_equal(self.data["stamp"], self.stamp):
+                self.chroms=self.data["chroms"].astype(str).tolist()
+                self.lengths=self.data["lengths"].tolist()
+                return
+            self.data.close()
+        self.build()
+
+    def build(self):
+        """
+        Read the mask fasta and save the runs in the cache. If the cache can't 
+        be written, the index is kept in memory. 
+        """
+        fai=read_fai(self.file)
+        self.chroms=[x[0] for x in fai]
+        self.lengths=[x[1] for x in fai]
+        data={"stamp":self.stamp, "chroms":np.array(self.chroms, dtype=bytes), "lengths":np.array(self.lengths)}
+        for i, chrom in enumerate(self.chroms):
+            starts=[]
+            values=[]
+            last=-1
+            offset=0
+            for window in fasta_windows(self.file, chrom, MASK_INDEX_WINDOW):
+                change=np.flatnonzero(window[1:]!=window[:-1])+1
+                if window[0]!=last:
+                    change=np.concatenate([[0], change])
+                starts.append(change+offset)
+                values.append(window[change])
+                last=window[-1]
+                offset+=len(window)
+            data["starts"+str(i)]=np.concatenate(starts+[np.zeros(0, dtype=np.int64)]).astype(np.int64)
+            data["values"+str(i)]=np.concatenate(values+[np.zeros(0, dtype=np.uint8)]).astype(np.uint8)
+        self.data=data
+        
+        cache=self.file+MASK_INDEX_SUFFIX
+        try:
+            tmp=open(cache+"."+str(os.getpid())+".tmp", "wb")
+            np.savez(tmp, **data)
+            tmp.close()
+            os.rename(tmp.name, cache)
+        except (IOError, OSError):
+            pass
+
+    def __contains__(self, chrom):
+        return chrom in self.chroms
+
+    def __getitem__(self, chrom):
+        if chrom not in self.runs:
+            if chrom not in self.chroms:
+                raise Exception("Chromosome "+chrom+" not in "+self.file)
+            i=self.chroms.index(chrom)
+            self.runs[chrom]=MaskRuns(self.data["starts"+str(i)], self.data["values"+str(i)], self.lengths[i])
+        return self.runs[chrom]
+
+################################################################################
+
+def eigenstrat_genotypes(gt):
+    """
+    Convert a VCFReader genotype array to eigenstrat genotypes (the number of 
+    reference alleles, 9 for missing). Haploid calls count as homozygous and 
+    anything other than alleles 0 and 1 is missing. 
+    """
+    biallelic=(gt>=0)&(gt<=1)
+    genos=np.where(biallelic[:,:,0]&biallelic[:,:,1], 2-gt[:,:,0]-gt[:,:,1], 9).astype(np.uint8)
+    haploid=gt[:,:,1]==HAPLOID
+    genos[haploid]=np.where(biallelic[:,:,0][haploid], 2-2*gt[:,:,0][haploid], 9)
+    return genos
+
+################################################################################
+
+class PsmcfaWriter(object):
+    """
+    Write psmcfa from hetfa sequence, binning as fq2psmcfa does: a bin is N if 
+    fewer than half its bases are called (not N), otherwise K if any of them is
+    heterozygous and T if not. Takes the same writes as a hetfa file - a header
+    line, then the sequence in pieces, ending with a newline. 
+    """
+    def __init__(self, out, bin_size=PSMCFA_BIN):
+        self.out=out
+        self.bin_size=bin_size
+        self.leftover=np.zeros(0, dtype=np.uint8)
+        self.column=0
+        self.het=np.zeros(256, dtype=bool)
+        for code in "RYSWKMryswkm":
+            self.het[ord(code)]=True
+
+    def write(self, data):
+        if data[:1]==b">":
+            self.out.write(data)
+            return
+        self.add(np.frombuffer(data.rstrip(b"\n"), dtype=np.uint8))
+        if data[-1:]==b"\n":
+            self.add(None)
+
+    def add(self, seq):
+        """
+        Bin a piece of sequence. None marks the end, when the last partial bin
+        is written. 
+        """
+        if seq is None:
+            bins=self.leftover.reshape(1, -1) if len(self.leftover) else np.zeros((0,0), dtype=np.uint8)
+            self.leftover=np.zeros(0, dtype=np.uint8)
+        else:
+            seq=np.concatenate([self.leftover, seq])
+            nbins=len(seq)//self.bin_size
+            bins=seq[:nbins*self.bin_size].reshape(nbins, self.bin_size)
+            self.leftover=seq[nbins*self.bin_size:]
+
+        called=((bins!=ord("N"))&(bins!=ord("n"))).sum(axis=1)
+        codes=np.where(self.het[bins].any(axis=1), ord("K"), ord("T"))
+        codes[2*called<self.bin_size]=ord("N")
+        self.write_codes(codes.astype(np.uint8))
+        if seq is None and self.column:
+            self.out.write(b"\n")
+            self.column=0
+
+    def write_codes(self, codes):
+        """
+        Write bin codes, wrapped at PSMCFA_WRAP per line
+        """
+        lines=[]
+        start=0
+        while start<len(codes):
+            end=min(len(codes), start+PSMCFA_WRAP-self.column)
+            lines.append(codes[start:end].tobytes())
+            self.column+=end-start
+            if self.column==PSMCFA_WRAP:
+                lines.append(b"\n")
+                self.column=0
+            start=end
+        self.out.write(b"".join(lines))
+
+    def close(self):
+        self.out.close()
+
+################################################################################
+
 def output_msmc(haps, chr, pos, alleles, options):
     """
     output a .msmc file. Assuming that there are 4 or 8 haplotypes
     If there are 8, we use [0,2,4,6] assuming there are 4 individuals
     """
-    out=open(options["out"]+".msmc", "w")
+    out=open2(options["out"]+".msmc"+(".gz" if options.get("bgzip") else ""), "w")
     last_site=0
     used_haps=haps
     if haps.shape[1]==8:
@@ -74,3 +888,429 @@ def output_psmc(haps, chr, pos, options):
         this_block+=1
 
 ################################################################################
+
+def hash_ids(ids, hash=0):
+    """
+    The eigensoft hash of a list of IDs, as stored in the header of packed
+    .geno files. Pass the previous value as hash to extend it with more IDs.
+    """
+    if not len(ids):
+        return hash
+    chars=np.array(ids, dtype=str).astype("S").view(np.uint8).reshape(len(ids), -1)
+    id_hash=np.zeros(len(ids), dtype=np.uint64)
+    for j in range(chars.shape[1]):
+        id_hash=np.where(chars[:,j]>0, id_hash*np.uint64(23)+chars[:,j], id_hash)
+    for h in (id_hash & np.uint64(0xffffffff)).tolist():
+        hash=((hash*17)^h) & 0xffffffff
+    return hash
+
+################################################################################
+
+class PackedGenoWriter(object):
+    """
+    Write a packed (PACKEDANCESTRYMAP) .geno file a block of snps at a time. 
+    The header holds the number of snps and the hash of their IDs, so it is
+    filled in again when the file is closed. 
+    """
+    def __init__(self, file, inds):
+        self.file=open(file, "wb")
+        self.nind=len(inds)
+        self.nbytes=(self.nind+3)//4
+        self.rlen=max(48, self.nbytes)
+        self.ind_hash=hash_ids(inds)
+        self.snp_hash=0
+        self.nsnp=0
+        self.file.write(self.header())
+
+    def header(self):
+        header="GENO %7d %7d %x %x"%(self.nind, self.nsnp, self.ind_hash, self.snp_hash)
+        return (header+"\0"*(self.rlen-len(header))).encode("ascii")
+
+    def write(self, genos, ids):
+        """
+        genos is an nsnp x nind array of eigenstrat genotypes (0, 1, 2 or 9)
+        and ids the corresponding snp IDs. 
+        """
+        codes=np.zeros((len(ids), 4*self.nbytes), dtype=np.uint8)
+        codes[:,:self.nind]=np.where(genos==9, 3, genos)
+        rows=np.zeros((len(ids), self.rlen), dtype=np.uint8)
+        rows[:,:self.nbytes]=(codes[:,0::4]<<6)|(codes[:,1::4]<<4)|(codes[:,2::4]<<2)|codes[:,3::4]
+        self.file.write(rows.tobytes())
+        self.snp_hash=hash_ids(ids, self.snp_hash)
+        self.nsnp+=len(ids)
+
+    def append(self, file, ids):
+        """
+        Append the snp records of another packed .geno file with the same
+        individuals. ids are the IDs of its snps. 
+        """
+        other=open(file, "rb")
+        other.seek(self.rlen)
+        shutil.copyfileobj(other, self.file)
+        other.close()
+        self.snp_hash=hash_ids(ids, self.snp_hash)
+        self.nsnp+=len(ids)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+################################################################################
+
+def write_ind(out, inds, ref=None, indmap=None, ind_as_pop=False):
+    """
+    Write out.ind for inds, with the reference ref first if given. Sex and 
+    population come from the indmap file (ID, sex, population) if given, the
+    population is the ID if ind_as_pop and POP otherwise.
+    """
+    ind=open(out+".ind", "w")
+    if ref:
+        ind.write(ref+"\tU\tREF\n")
+            
+    if indmap:
+        pop_map={}
+        sex_map={}
+        ind_map_file=open(indmap, "r")
+        for line in ind_map_file:
+            bits=line[:-1].split()
+            pop_map[bits[0]]=bits[2]
+            sex_map[bits[0]]=bits[1]
+        ind_map_file.close()
+        for indi in inds:
+            ind.write(indi+"\t"+sex_map.get(indi, "U")+"\t"+pop_map.get(indi, "POP")+"\n")
+    elif ind_as_pop:
+        for indi in inds:
+            ind.write(indi+"\tU\t"+indi+"\n")
+    else:
+        for indi in inds:
+            ind.write(indi+"\tU\tPOP\n")
+    ind.close()
+
+################################################################################
+
+def write_eigenstrat(chunks, out, inds, ref=False, packed=False, bgzip=False):
+    """
+    Write VCFReader chunks to out.snp and out.geno, dropping indels and 
+    multiallelic sites. inds are the individuals in the .geno file, the first 
+    being a reference that is always homozygous if ref. The .geno file is 
+    packed if packed, and both files are bgzipped if bgzip. Returns the number 
+    of sites written and a dictionary of removed sites. 
+    """
+    suffix=".gz" if bgzip else ""
+    snp=open2(out+".snp"+suffix, "w")
+    if packed:
+        geno=PackedGenoWriter(out+".geno", inds)
+    else:
+        geno=open2(out+".geno"+suffix, "w")
+    removed={"multiallelic":0, "indel":0}
+    count=0
+    
+    for chunk in chunks:
+        indel=np.char.find(chunk["ALT"], ",")>=0
+        multiallelic=~indel&((np.char.str_len(chunk["REF"])!=1)|(np.char.str_len(chunk["ALT"])!=1))
+        removed["indel"]+=int(indel.sum())
+        removed["multiallelic"]+=int(multiallelic.sum())
+        keep=~(indel|multiallelic)
+        if keep.any():
+            write_eigenstrat_chunk(snp, geno, chunk, keep, ref, packed)
+            count+=int(keep.sum())
+
+    [f.close() for f in [snp, geno]]
+    return count, removed
+
+################################################################################
+
+def write_eigenstrat_chunk(snp, geno, chunk, keep, ref=False, packed=False):
+    """
+    Write the sites of a chunk in keep to the .snp and .geno files, one write
+    each. Genotypes that are neither haploid nor diploid raise an exception.
+    """
+    chrom=chunk["CHROM"][keep]
+    pos=chunk["POS"][keep].astype(str)
+    if "UNKNOWN" in chunk and chunk["UNKNOWN"][keep].any():
+        site, sample=np.argwhere(chunk["UNKNOWN"][keep])[0]
+        raise Exception("Unknown genotype: sample "+str(sample+1)+" at "+chrom[site]+":"+pos[site])
+    ids=chunk["ID"][keep]
+    ids=np.where(ids==".", np.char.add(np.char.add(chrom, ":"), pos), ids)
+    zero=["0.0"]*len(ids)
+    snp.write("".join(["    ".join(x)+"\n" for x in zip(ids.tolist(), chrom.tolist(), zero, pos.tolist(), 
+                                                        chunk["REF"][keep].tolist(), chunk["ALT"][keep].tolist())]))
+
+    genos=eigenstrat_genotypes(chunk["GT"][keep])
+    if ref:
+        genos=np.hstack([np.full((len(ids),1), 2, dtype=np.uint8), genos])
+
+    if packed:
+        geno.write(genos, ids)
+    else:
+        genos=np.hstack([genos+ord("0"), np.full((len(ids),1), ord("\n"), dtype=np.uint8)])
+        geno.write(genos.tobytes())
+
+################################################################################
+
+class NpyWriter(object):
+    """
+    Write a 2D .npy file a block of rows at a time. The header holds the 
+    number of rows, so it is padded to a fixed length and filled in again 
+    when the file is closed. The file can then be loaded with np.load, and 
+    memory mapped (mmap_mode="r"). 
+    """
+    def __init__(self, file, ncol, dtype="<i4"):
+        self.file=open(file, "wb")
+        self.ncol=ncol
+        self.dtype=np.dtype(dtype)
+        self.nrow=0
+        self.file.write(self.header())
+
+    def header(self):
+        header="{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }"%(self.dtype.str, self.nrow, self.ncol)
+        # Room for any number of rows, and a multiple of 64 bytes in all
+        header=header.ljust(128-10-1)+"\n"
+        return b"\x93NUMPY\x01\x00"+struct.pack("<H", len(header))+header.encode("ascii")
+
+    def write(self, rows):
+        self.file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.nrow+=len(rows)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+################################################################################
+
+def read_panel(panel_file):
+    """
+    Open the panel file and return a dictionary that maps sample to popuation
+    """
+    map={}
+    pf=open(panel_file, "r")
+    for line in pf:
+        bits=line.split()
+        map[bits[0]]=bits[1]
+        
+    pops=list(set(map.values())) 
+    pops.sort()   
+    
+    return map, pops
+
+################################################################################
+
+def pop_index(samples, map, pops):
+    """
+    Integer population index (into pops) of each sample in the panel, and the 
+    samples sorted by population, so each population is a block of columns.
+    """
+    samples=[x for x in samples if x in map]
+    index=dict((pop, i) for i, pop in enumerate(pops))
+    pop_idx=np.array([index[map[x]] for x in samples], dtype=int)
+    order=np.argsort(pop_idx, kind="mergesort")
+    return [samples[i] for i in order], pop_idx[order]
+
+################################################################################
+
+def pop_sums(values, pop_idx, npops):
+    """
+    Sum an nsite x nsample array over the samples of each population. The 
+    columns are sorted by population. 
+    """
+    sums=np.zeros((values.shape[0], npops), dtype=int)
+    if len(pop_idx):
+        present, starts=np.unique(pop_idx, return_index=True)
+        sums[:,present]=np.add.reduceat(values, starts, axis=1)
+    return sums
+
+################################################################################
+
+def count_alleles(gt, pop_idx, npops):
+    """
+    Count the alt alleles and the called (0 or 1) alleles of each population 
+    at each site of a genotype array, whose columns are sorted by population.
+    """
+    alt=(gt==1).sum(axis=2)
+    called=alt+(gt==0).sum(axis=2)
+    return pop_sums(alt, pop_idx, npops), pop_sums(called, pop_idx, npops)
+
+################################################################################
+
+def site_cols(chunk):
+    """
+    The SITE_COLS of each site in a chunk, as tuples.
+    """
+    return list(zip(chunk["ID"].tolist(), chunk["CHROM"].tolist(), chunk["POS"].astype(str).tolist(), 
+                    chunk["REF"].tolist(), chunk["ALT"].tolist()))
+
+################################################################################
+
+class CountsWriter(object):
+    """
+    Write population allele counts as out.alt.npy and out.total.npy, nsite x
+    npop int32 arrays of alt and called allele counts, with every site in 
+    out.sites (the SITE_COLS) and the populations in out.pops. 
+    """
+    def __init__(self, out, pops):
+        pop_file=open(out+".pops", "w")
+        pop_file.write("".join([pop+"\n" for pop in pops]))
+        pop_file.close()
+        self.sites=open(out+".sites", "w")
+        self.sites.write("\t".join(SITE_COLS)+"\n")
+        self.alt=NpyWriter(out+".alt.npy", len(pops))
+        self.total=NpyWriter(out+".total.npy", len(pops))
+
+    def write(self, result):
+        """
+        Write a block of sites, given as the site table lines and the alt and
+        total count arrays. 
+        """
+        sites, counts, totals=result
+        self.sites.write(sites)
+        self.alt.write(counts)
+        self.total.write(totals)
+
+    def write_chunk(self, chunk, pop_idx):
+        """
+        Count and write a chunk whose genotype columns are sorted by the 
+        population indices pop_idx. 
+        """
+        counts, totals=count_alleles(chunk["GT"], pop_idx, self.alt.ncol)
+        self.write(("".join(["\t".join(col)+"\n" for col in site_cols(chunk)]), counts, totals))
+
+    def close(self):
+        [f.close() for f in [self.sites, self.alt, self.total]]
+
+################################################################################
+
+class SnpIndex(object):
+    """
+    Index of an eigenstrat .snp file, cached in file+SNP_INDEX_SUFFIX and 
+    rebuilt if the file's size or modification time changes. Holds the columns
+    as arrays (ID, CHR, GPOS, POS, REF, ALT) and finds the rows of snp IDs, 
+    and of chromosomes or regions, by binary search. 
+    """
+    def __init__(self, file):
+        self.file=file
+        stat=os.stat(file)
+        stamp=np.array([stat.st_size, stat.st_mtime])
+        cache=file+SNP_INDEX_SUFFIX
+        if os.path.exists(cache):
+            data=np.load(cache)
+            if np.array_equal(data["stamp"], stamp):
+                self.load(data)
+                return
+        
+        rows=[line.split() for line in open(file) if line.strip()]
+        if any([len(bits)<6 for bits in rows]):
+            raise Exception("Need 6 columns (with alleles) in "+file)
+        data={"stamp":stamp}
+        for i, column in enumerate(["ID", "CHR", "GPOS", "POS", "REF", "ALT"]):
+            data[column]=np.array([bits[i] for bits in rows], dtype=bytes)
+        data["POS"]=data["POS"].astype(np.int64)
+        data["ORDER"]=np.argsort(data["ID"], kind="mergesort")
+        #Rows of each chromosome, if it's in one piece. 
+        chroms, starts, counts=np.unique(data["CHR"], return_index=True, return_counts=True)
+        data["CHROMS"]=chroms
+        data["CHROM_ROWS"]=np.array([starts, starts+counts]).T
+        data["CHROM_SORTED"]=np.array([(data["CHR"][a:b]==c).all() and (np.diff(data["POS"][a:b])>=0).all() 
+                                       for c, (a, b) in zip(chroms, data["CHROM_ROWS"])], dtype=bool)
+        try:
+            tmp=open(cache+"."+str(os.getpid())+".tmp", "wb")
+            np.savez(tmp, **data)
+            tmp.close()
+            os.rename(tmp.name, cache)
+        except (IOError, OSError):
+            pass
+        self.load(data)
+
+    def load(self, data):
+        for column in ["ID", "CHR", "GPOS", "REF", "ALT", "CHROMS"]:
+            setattr(self, column, data[column].astype(str))
+        for column in ["POS", "ORDER", "CHROM_ROWS", "CHROM_SORTED"]:
+            setattr(self, column, data[column])
+        self.sorted_ids=self.ID[self.ORDER]
+
+    def __len__(self):
+        return len(self.ID)
+
+    def rows(self, ids):
+        """
+        The rows of the snps with these IDs, in file order. Missing IDs are 
+        ignored. 
+        """
+        ids=np.array(ids, dtype=str)
+        found=np.searchsorted(self.sorted_ids, ids)
+        ok=found<len(self)
+        found, ids=found[ok], ids[ok]
+        found=found[self.sorted_ids[found]==ids]
+        return np.unique(self.ORDER[found])
+
+    def region(self, chrom, start=None, end=None):
+        """
+        The rows of the snps on chrom, from start to end (1-based, inclusive) 
+        if given, in file order. 
+        """
+        i=np.searchsorted(self.CHROMS, chrom)
+        if i>=len(self.CHROMS) or self.CHROMS[i]!=chrom:
+            return np.zeros(0, dtype=int)
+        if not self.CHROM_SORTED[i]:
+            rows=np.flatnonzero(self.CHR==chrom)
+            keep=np.ones(len(rows), dtype=bool)
+            if start is not None:
+                keep&=self.POS[rows]>=start
+            if end is not None:
+                keep&=self.POS[rows]<=end
+            return rows[keep]
+        first, last=self.CHROM_ROWS[i]
+        pos=self.POS[first:last]
+        lo=np.searchsorted(pos, start, side="left") if start is not None else 0
+        hi=np.searchsorted(pos, end, side="right") if end is not None else len(pos)
+        return np.arange(first+lo, first+hi)
+
+################################################################################
+
+def read_ind(file):
+    """
+    Read an eigenstrat .ind file into a list of (ID, sex, population).
+    """
+    return [tuple(line.split()[:3]) for line in open(file) if line.strip()]
+
+################################################################################
+
+class GenoReader(object):
+    """
+    Random access to the rows of an eigenstrat .geno file, packed or not. Both 
+    have fixed length records, so the file is memory mapped and only the rows, 
+    and the bytes of the individuals, that are asked for are read. 
+    """
+    def __init__(self, file, nind, nsnp):
+        self.file=file
+        self.nind=nind
+        header=open(file, "rb").read(4)
+        size=os.path.getsize(file)
+        if header==b"GENO":
+            self.packed=True
+            rlen=max(48, (nind+3)//4)
+            offset=rlen
+        else:
+            self.packed=False
+            rlen=nind+1
+            offset=0
+        if size!=offset+nsnp*rlen:
+            raise Exception(file+" is not the right size for "+str(nind)+" individuals and "+str(nsnp)+" snps")
+        self.data=np.memmap(file, dtype=np.uint8, mode="r", offset=offset, shape=(nsnp, rlen))
+
+    def read(self, rows, inds=None):
+        """
+        Genotypes (0, 1, 2 or 9) of the snps in rows for the individuals in 
+        inds (default all), as an nrow x nind array. 
+        """
+        inds=np.arange(self.nind) if inds is None else np.asarray(inds, dtype=int)
+        rows=np.asarray(rows, dtype=int)
+        if self.packed:
+            #Only read the bytes that hold these individuals, then decode each one
+            cols=np.unique(inds//4)
+            block=self.data[rows[:,None], cols]
+            codes=(block[:,np.searchsorted(cols, inds//4)]>>(6-2*(inds%4)).astype(np.uint8))&3
+            codes+=(codes==3)*np.uint8(6)
+            return codes
+        return self.data[rows[:,None], inds]-np.uint8(ord("0"))
@@ -3,16 +3,25 @@
 #Replaces everything in the orginal fasta with Ns if it is below the integer level specified
 #If no mask file is specificed, then it just produces an output that reads 0/1/2/3/4 according to 
 #whether the input is uncalled (0) or called
+#With no mask, -f can be many fastas (e.g. per-sample hetfas, gzipped or not) with the same 
+#chromosomes, and the output counts how many of them are called at each base, capped at 9.
+#The mask is read through a run-length index, cached next to it as mask.fa.rle.npz
+#With -p, masked chromosomes wait to be written in temporary files in -t (default the current directory)
 
 from __future__ import division, print_function
-import argparse, sys
-from pyfaidx import Fasta
+import argparse, collections, multiprocessing, os, shutil, sys, tempfile, gdc
+import numpy as np
  
 WRAP_LENGTH=50
+# Bases masked at once - a whole number of lines
+WINDOW_SIZE=WRAP_LENGTH*20000
 
 IUPAC_ACGT=["A","C","G","T"]
 IUPAC_HETS=["R", "Y", "S", "W", "K", "M"]
 IUPAC_CALLS=IUPAC_ACGT+IUPAC_HETS
+# Lookup table from fasta bytes to whether the base is called
+CALLED=np.zeros(256, dtype=np.uint16)
+CALLED[[ord(x) for x in IUPAC_CALLS]]=1
  
 ################################################################################
 
@@ -21,49 +30,168 @@ def parse_options():
     argparse
     """
     parser=argparse.ArgumentParser()
-    parser.add_argument('-f', '--fasta', type=str, default="", help=
-                        "input fasta file")
+    parser.add_argument('-f', '--fasta', type=str, nargs="+", default=[], help=
+                        "input fasta file(s) - only one if there's a mask")
     parser.add_argument('-m', '--mask', type=str, default="", help=
                         "Mask file (fasta)")
     parser.add_argument('-c', '--level', type=int, default=1, help=
                         "Filter level")
+    parser.add_argument('-p', '--processes', type=int, default=1, help=
+                        "Number of chromosomes to mask at once")
+    parser.add_argument('-t', '--temp_dir', type=str, default=".", help=
+                        "Directory for the masked chromosomes waiting to be written with -p")
 
     return parser.parse_args()
 
 ################################################################################
 
+def mask_chrom(chrom, fasta, runs, options, out):
+    """
+    Write one masked chromosome to out. runs is the chromosome from the mask
+    index: bases are kept if the mask is a digit at least level. 
+    """
+    out.write(">"+chrom+"\n")
+    start=0
+    for faseq in gdc.fasta_windows(fasta, chrom, WINDOW_SIZE):
+        end=start+len(faseq)
+        for mask_start, mask_end in runs.masked_intervals(start, end, options.level):
+            faseq[mask_start-start:mask_end-start]=ord("N")
+        out.write(gdc.wrap_seq(faseq, WRAP_LENGTH))
+        start=end
+
+################################################################################
+
+def mask_chrom_job(args):
+    """
+    Mask one chromosome in a worker process, into the temporary file tmp_file. 
+    """
+    chrom, fasta, runs, options, tmp_file=args
+    out=open(tmp_file, "wb")
+    mask_chrom(chrom, fasta, runs, options, out)
+    out.close()
+
+################################################################################
+
+def mask_parallel(chroms, fasta, index, options, pool):
+    """
+    Mask chromosomes in parallel into temporary files in temp_dir and write 
+    them to stdout in order as they finish. At most one chromosome more than
+    the number of processes is in flight, and the temporary files are removed
+    even if masking fails. 
+    """
+    tmp_files=[]
+    pending=collections.deque()
+    try:
+        for chrom in chroms:
+            fd, tmp_file=tempfile.mkstemp(prefix="maskfa.", suffix=".fa", dir=options.temp_dir)
+            os.close(fd)
+            tmp_files.append(tmp_file)
+            pending.append((chrom, tmp_file, pool.apply_async(mask_chrom_job, ((chrom, fasta, index[chrom], options, tmp_file),))))
+            if len(pending)>options.processes:
+                write_chrom(*pending.popleft())
+        while pending:
+            write_chrom(*pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+################################################################################
+
+def write_chrom(chrom, tmp_file, result):
+    """
+    Wait for a chromosome to be masked and copy it to stdout.
+    """
+    result.get()
+    print("Masked chromosome "+chrom, file=sys.stderr)
+    tmp=open(tmp_file, "rb")
+    shutil.copyfileobj(tmp, sys.stdout)
+    tmp.close()
+    os.remove(tmp_file)
+
+################################################################################
+
+def build_index(mask):
+    """
+    Build the mask index in a worker process, so it's cached for main
+    """
+    gdc.MaskIndex(mask)
+
+################################################################################
+
 def main(options):
     """
     print masked fasta
     """
-    fa=Fasta(options.fasta)
-
     if options.mask:
-        mask=Fasta(options.mask)
-        if not set(fa.keys()).issubset(set(mask.keys())): 
-            raise Exception("Mask does not include all chromosomes in fasta")
-        chroms=[x for x in fa.keys()]
+        if len(options.fasta)!=1:
+            raise Exception("Can only mask one fasta at a time")
+        fasta=options.fasta[0]
+        pool=None
+        if options.processes>1:
+            pool=multiprocessing.Pool(options.processes)
+        try:
+            #Index both files at once if they need it. 
+            if pool:
+                fa_fai=pool.apply_async(gdc.read_fai, (fasta,))
+                pool.apply(build_index, (options.mask,))
+                fa_fai=fa_fai.get()
+            else:
+                fa_fai=gdc.read_fai(fasta)
+            index=gdc.MaskIndex(options.mask)
+            fa_lengths=[(x[0], x[1]) for x in fa_fai]
+            mask_lengths=dict(zip(index.chroms, index.lengths))
+            if not set(dict(fa_lengths).keys()).issubset(set(mask_lengths.keys())): 
+                raise Exception("Mask does not include all chromosomes in fasta")
+            chroms=[x[0] for x in fa_lengths]
     
-        for chrom in chroms:
-            if len(fa[chrom][:]) != len(mask[chrom][:]):
-                raise Exception("Chromosome "+chrom+" is different length in mask than fasta")
+            for chrom, length in fa_lengths:
+                if length != mask_lengths[chrom]:
+                    raise Exception("Chromosome "+chrom+" is different length in mask than fasta")
     
-        for chrom in chroms: 
-            print("Masking chromosome "+chrom, file=sys.stderr)
-            faseq=fa[chrom][:].seq
-            maskseq=mask[chrom][:].seq
-            new_seq="".join([x if y.isdigit() and int(y)>=options.level else "N" for x,y in zip(faseq,maskseq)])
-            wrap_seq="\n".join(new_seq[i:i+WRAP_LENGTH] for i in range(0,len(new_seq), WRAP_LENGTH))
-            print(">"+chrom)
-            print(wrap_seq)
+            if pool:
+                mask_parallel(chroms, fasta, index, options, pool)
+            else:
+                for chrom in chroms: 
+                    print("Masking chromosome "+chrom, file=sys.stderr)
+                    mask_chrom(chrom, fasta, index[chrom], options, sys.stdout)
+        finally:
+            if pool:
+                pool.terminate()
     else:
-        for chrom in chroms: 
-            print("Masking chromosome "+chrom, file=sys.stderr)
-            faseq=fa[chrom][:].seq
-            new_seq="".join(["1" if x in IUPAC_CALLS else "0" for x in faseq])
-            wrap_seq="\n".join(new_seq[i:i+WRAP_LENGTH] for i in range(0,len(new_seq), WRAP_LENGTH))
-            print(">"+chrom)
-            print(wrap_seq)
+        count_called(options.fasta, sys.stdout)
+
+################################################################################
+
+def count_called(fastas, out):
+    """
+    Write a mask counting, at each base, how many of the fastas are called, 
+    capped at 9. The fastas are read together, a window at a time, so they 
+    must have the same chromosomes in the same order. 
+    """
+    streams=[gdc.fasta_stream(fasta, WINDOW_SIZE) for fasta in fastas]
+    last_chrom=None
+    while True:
+        windows=[next(stream, None) for stream in streams]
+        if all([window is None for window in windows]):
+            break
+        if any([window is None for window in windows]):
+            raise Exception("Fastas have different chromosomes")
+        chrom=windows[0][0]
+        if any([window[0]!=chrom or len(window[1])!=len(windows[0][1]) for window in windows]):
+            raise Exception("Fastas have different chromosomes or lengths at chromosome "+chrom)
+        
+        if chrom!=last_chrom:
+            print("Counting chromosome "+chrom, file=sys.stderr)
+            out.write(">"+chrom+"\n")
+            last_chrom=chrom
+        counts=np.zeros(len(windows[0][1]), dtype=np.uint16)
+        for window in windows:
+            counts+=CALLED[window[1]]
+        counts=(np.minimum(counts, 9)+ord("0")).astype(np.uint8)
+        out.write(gdc.wrap_seq(counts, WRAP_LENGTH))
         
     
 ################################################################################
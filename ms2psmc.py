@@ -1,6 +1,7 @@
 # Converts a 4 haplotype macs output file (from msformatter)
 # to msmc input format. Optionally add exponentially distributed phasing
 # switch and flip errors between samples (0,1) and (2,3) 
+# -r seeds the phasing errors, so they can be reproduced
 
 from __future__ import division
 import sys, getopt, gdc, gzip, pdb
@@ -15,10 +16,10 @@ def parse_options():
     out: root for .msmc output
     individuals: either 2 or 4 samples from the sample file. 
     """
-    options ={ "input":None, "out":None, "switch_rate":0,  "flip_rate":0, "chr":0, "msmc":False, "psmc":False ,"macs":False, "length":None}
+    options ={ "input":None, "out":None, "switch_rate":0,  "flip_rate":0, "chr":0, "msmc":False, "psmc":False ,"macs":False, "length":None, "bgzip":False, "seed":None}
 	
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "i:o:s:f:c:l:mpa", ["ms", "out", "switch_rate", "flip_rate", "chr", "msmc", "psmc", "macs"])
+        opts, args = getopt.getopt(sys.argv[1:], "i:o:s:f:c:l:mpazr:", ["ms", "out", "switch_rate", "flip_rate", "chr", "msmc", "psmc", "macs", "bgzip", "seed="])
         print opts, args
     except Exception as err:
         print str(err)
@@ -35,6 +36,8 @@ def parse_options():
         elif o in ["-m","--msmc"]:     options["msmc"] = True
         elif o in ["-p","--psmc"]:     options["psmc"] = True
         elif o in ["-a","--macs"]:     options["macs"] = True
+        elif o in ["-z","--bgzip"]:    options["bgzip"] = True
+        elif o in ["-r","--seed"]:     options["seed"] = int(a)
 
     print "found options:"
     print options
@@ -46,27 +49,27 @@ def parse_options():
 
 ################################################################################
 
-def add_phasing_errors(haps, switch_rate, flip_rate):
+def add_phasing_errors(haps, switch_rate, flip_rate, seed=None):
     """
-    Add phasing errors to 2 haplotypes with swtiches and flip rates per site
+    Add phasing errors to each pair of haplotypes - (0,1), (2,3) etc. - with 
+    switch and flip rates per site. A switch swaps the pair from that site on, 
+    so a site is swapped if there has been an odd number of switches up to and
+    including it, unless it's also flipped. seed seeds the random numbers. 
     """
 
     npos,nhap = haps.shape
-    if nhap!=2:
-        raise Exception("Can only add switch errors to 2 haplotypes")
-
-    switches=np.random.uniform(size=npos)<switch_rate
-    flips=np.random.uniform(size=npos)<flip_rate
-    for i in range(npos):
-        if switches[i]:
-            tmp=haps[i:,0].copy()
-            haps[i:,0]=haps[i:,1]
-            haps[i:,1]=tmp
-        if flips[i]:
-            tmp=haps[i,0]
-            haps[i,0]=haps[i,1]
-            haps[i,1]=tmp
-            
+    if nhap%2:
+        raise Exception("Can only add switch errors to pairs of haplotypes")
+
+    rng=np.random.RandomState(seed)
+    switches=rng.uniform(size=(npos, nhap//2))<switch_rate
+    flips=rng.uniform(size=(npos, nhap//2))<flip_rate
+    swap=(np.cumsum(switches, axis=0)%2==1)^flips
+
+    first=haps[:,0::2].copy()
+    second=haps[:,1::2].copy()
+    haps[:,0::2]=np.where(swap, second, first)
+    haps[:,1::2]=np.where(swap, first, second)
     return haps
 
 ################################################################################
@@ -123,8 +126,7 @@ def main(options):
     if options["switch_rate"]>0 or options["flip_rate"]>0:
         site_switch_rate=options["switch_rate"]*length/len(pos)
         site_flip_rate=options["flip_rate"]*length/len(pos)        
-        for i in range(int(nhaps/2)):
-            haps[:,[2*i,2*i+1]]=add_phasing_errors(haps[:,[2*i,2*i+1]], site_switch_rate, site_flip_rate)
+        haps=add_phasing_errors(haps, site_switch_rate, site_flip_rate, options["seed"])
 
     alleles=np.zeros( (npos,2), dtype=str)
     alleles[:,0]="A"
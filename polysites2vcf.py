@@ -1,12 +1,25 @@
 #This is for converting Shop Mallick's polysite format to vcf
 #Probably only useful to you if you are working on the SGDP 
 #Very specific to this particular format.
+#With -c, an uncompressed input is read through an index of where each chromosome 
+#starts and ends, input.chroms, which is built the first time. -n converts all the 
+#chromosomes in parallel, each to out.chrom.vcf (or out.chrom.* for other formats)
+#-f eigenstrat or packed writes out.snp/.ind/.geno as vcf2eigenstrat.py would from the vcf, 
+#and -f counts with -p panel writes population allele counts as vcf2freq.py -o would, 
+#without writing and parsing a vcf.
 
 from __future__ import division, print_function
-import argparse, sys, pdb
+import argparse, multiprocessing, os, sys, gdc, pdb
+import numpy as np
 
 #Remember, in eigenstrat, 2 means "2 ref copies"
 
+INCLUDE_ANCIENTS=False
+INCLUDE_REFS=False
+
+# Suffix of the chromosome index
+INDEX_SUFFIX=".chroms"
+
 CODES={
        "A":"AA",
        "C":"CC",
@@ -22,6 +35,19 @@ CODES={
        "N":"..",
     }
 
+# CODES as lookup tables from (either case) bytes to the bytes of the first 
+# and second alleles. 0 means not a code. 
+FIRST_ALLELE=np.zeros(256, dtype=np.uint8)
+SECOND_ALLELE=np.zeros(256, dtype=np.uint8)
+for code, alleles in CODES.items():
+    for c in set([code, code.lower()]):
+        FIRST_ALLELE[ord(c)], SECOND_ALLELE[ord(c)]=ord(alleles[0]), ord(alleles[1])
+
+# The order alt alleles come out of a python 2 set, and the ALT column for 
+# each subset of them, indexed by a bitmask in that order. 
+ALT_ORDER="ACTG"
+ALT_STRINGS=[",".join([a for k, a in enumerate(ALT_ORDER) if mask&(1<<k)]) for mask in range(16)]
+
 ################################################################################
 
 def parse_options():
@@ -29,86 +55,304 @@ def parse_options():
     argparse
     """
     parser=argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', type=argparse.FileType('r'), default="-")
+    parser.add_argument('-i', '--input', type=str, default="-", help=
+                        "polysite file, or - for stdin")
     parser.add_argument('-c', '--chrom', type=str, default="")
+    parser.add_argument('-n', '--processes', type=int, default=1, help=
+                        "Convert every chromosome in parallel, to out.chrom")
+    parser.add_argument('-o', '--out', type=str, default=None, help=
+                        "Output root, needed with -n and for formats other than vcf")
+    parser.add_argument('-f', '--format', type=str, choices=["vcf", "eigenstrat", "packed", "counts"], default="vcf", help=
+                        "Write vcf, eigenstrat (.snp, .ind and .geno), packed eigenstrat or vcf2freq binary counts")
+    parser.add_argument('-p', '--panel', type=str, default=None, help=
+                        "Two column file mapping samples to populations, for counts")
 
     return parser.parse_args()
 
 ################################################################################
 
-def main(options):
+def read_header(lines):
     """
-    Convert
+    Read the header lines and return the samples and the columns their 
+    alleles are in. Stops after the #CHROM line. 
     """
     samples=[]    
-    include_ancients=False
-    include_refs=False
-    
-    reading_header=True
-    for line in options.input:
+    for line in lines:
         if len(line)==1:
             continue
-        elif line[:2]=="##" and reading_header:
+        elif line[:2]=="##":
             bits=line.split()
             if len(bits)<4:
                 continue
             elif bits[1]!="..":
                 continue
-            elif bits[2][0]=="3" and include_refs: #Refs
+            elif bits[2][0]=="3" and INCLUDE_REFS: #Refs
                 samples.append(bits[3])
             elif bits[2][0]=="4": #C team
                 samples.append(bits[7])
             elif bits[2][0]=="5": #B team with cteam processing
                 samples.append(bits[7])
-            elif bits[2][0]=="7" and include_ancients: #Ancients
+            elif bits[2][0]=="7" and INCLUDE_ANCIENTS: #Ancients
                 samples.append(bits[4].split(":")[0])
             elif bits[2][0]=="8": #A/B team, original
                 samples.append(bits[4].split(":")[0])
-        elif line[0]=="#" and reading_header:
-            reading_header=False
-            print("##fileformat=VCFv4.2")
-            print("##source=polysites2vcf.py")
-            print("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">")
-            print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join(samples))
-        elif not reading_header:
-            bits=line.split()
-            chrom=bits[0]
-
-            if options.chrom and options.chrom!=chrom:
-                continue
-
-            poss=bits[1]
-            idd=chrom+"_"+poss
-            ref=bits[2][0]
-            
-            alleles=(bits[3]+bits[4]+bits[7]).upper()
-            if include_refs and include_ancients:
-                alleles=(bits[2]+bits[3]+bits[4]+bits[6]+bits[7]).upper()
-            elif include_refs:
-                alleles=(bits[2]+bits[3]+bits[4]+bits[7]).upper()
-            elif include_ancients:
-                alleles=(bits[3]+bits[4]+bits[6]+bits[7]).upper()
-            
-            gts = [CODES[x] for x in alleles]
-            alt_alleles=list(set([x for x in "".join(gts) if (x!=ref and x!=".")]))
-            
-            if not len(alt_alleles):
-                continue
-            
-            alt=",".join(alt_alleles)
-            
-            allele_map={ref:"0", ".":"."}
-            for i,a in enumerate(alt_alleles):
-                allele_map[a]=str(i+1)
-            
-            gt_strings=[allele_map[x[0]]+"/"+allele_map[x[1]] for x in gts]
-            print("\t".join([chrom, poss, idd, ref, alt, "100", ".", ".", "GT"]+gt_strings))
-            
+        elif line[0]=="#":
+            break
         else: 
             print(line, file=sys.stderr)
             raise Exception("Header line in unexpected place")
-            
 
+    columns=[3,4,7]
+    if INCLUDE_REFS and INCLUDE_ANCIENTS:
+        columns=[2,3,4,6,7]
+    elif INCLUDE_REFS:
+        columns=[2,3,4,7]
+    elif INCLUDE_ANCIENTS:
+        columns=[3,4,6,7]
+    return samples, columns
+
+################################################################################
+
+def write_header(samples, out):
+    """
+    Write the vcf header
+    """
+    out.write("##fileformat=VCFv4.2\n")
+    out.write("##source=polysites2vcf.py\n")
+    out.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n")
+    out.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join(samples)+"\n")
+
+################################################################################
+
+def site_chunks(lines, columns, options):
+    """
+    Generate chunks of sites from polysite data lines, a block at a time. 
+    """
+    block=[]
+    for line in lines:
+        if len(line)==1:
+            continue
+        block.append(line)
+        if len(block)==gdc.CHUNK_SIZE:
+            chunk=parse_block(block, columns, options)
+            if chunk:
+                yield chunk
+            block=[]
+    if block:
+        chunk=parse_block(block, columns, options)
+        if chunk:
+            yield chunk
+
+################################################################################
+
+def write_sites(samples, chunks, options, out=None):
+    """
+    Write chunks of sites in options.format. out is the output root, or 
+    for vcf the output file (default stdout). 
+    """
+    if options.format=="vcf":
+        vcf=sys.stdout if out is None else open(out+".vcf", "w")
+        write_header(samples, vcf)
+        for chunk in chunks:
+            vcf.write(vcf_lines(chunk))
+        if out is not None:
+            vcf.close()
+    elif options.format in ["eigenstrat", "packed"]:
+        gdc.write_ind(out, samples)
+        count, removed=gdc.write_eigenstrat(chunks, out, samples, packed=options.format=="packed")
+        print("Wrote "+str(count)+" sites to "+out+", excluded "+str(sum(removed.values()))+" multiallelic", file=sys.stderr)
+    elif options.format=="counts":
+        map, pops=gdc.read_panel(options.panel)
+        panel_samples, pop_idx=gdc.pop_index(samples, map, pops)
+        cols=[samples.index(x) for x in panel_samples]
+        counts=gdc.CountsWriter(out, pops)
+        for chunk in chunks:
+            chunk["GT"]=chunk["GT"][:,cols]
+            counts.write_chunk(chunk, pop_idx)
+        counts.close()
+
+################################################################################
+
+def chrom_index(file):
+    """
+    The byte offsets of the start and end of each chromosome's lines in a 
+    polysite file, as a dictionary. The index is cached in file.chroms, and
+    rebuilt if the file's size or modification time changes. 
+    """
+    stat=os.stat(file)
+    stamp="#"+str(stat.st_size)+"\t"+repr(stat.st_mtime)+"\n"
+    cache=file+INDEX_SUFFIX
+    if os.path.exists(cache):
+        lines=open(cache).readlines()
+        if lines and lines[0]==stamp:
+            return dict((bits[0], (int(bits[1]), int(bits[2]))) for bits in [line.split() for line in lines[1:]])
+
+    index={}
+    chroms=[]
+    chrom=None
+    offset=0
+    polysites=open(file)
+    for line in polysites:
+        offset+=len(line)
+        if line[:1]=="#" and line[:2]!="##":
+            break
+    for line in polysites:
+        if len(line)>1:
+            this_chrom=line.split(None, 1)[0]
+            if this_chrom!=chrom:
+                if this_chrom in index:
+                    raise Exception("Chromosome "+this_chrom+" is not in one piece in "+file)
+                index[this_chrom]=[offset, offset]
+                chroms.append(this_chrom)
+                chrom=this_chrom
+        offset+=len(line)
+        if chrom is not None:
+            index[chrom][1]=offset
+    polysites.close()
+
+    try:
+        out=open(cache, "w")
+        out.write(stamp)
+        out.write("".join([chrom+"\t"+str(index[chrom][0])+"\t"+str(index[chrom][1])+"\n" for chrom in chroms]))
+        out.close()
+    except (IOError, OSError):
+        pass
+    return dict((chrom, tuple(offsets)) for chrom, offsets in index.items())
+
+################################################################################
+
+def read_range(file, start, end):
+    """
+    Generate the lines of file from byte offset start to end. 
+    """
+    polysites=open(file)
+    polysites.seek(start)
+    offset=start
+    for line in polysites:
+        if offset>=end:
+            break
+        offset+=len(line)
+        yield line
+    polysites.close()
+
+################################################################################
+
+def convert_chrom(file, chrom, offsets, options, out=None):
+    """
+    Convert one chromosome, reading only its lines
+    """
+    samples, columns=read_header(open(file))
+    lines=read_range(file, offsets[0], offsets[1]) if offsets else []
+    write_sites(samples, site_chunks(lines, columns, options), options, out)
+
+################################################################################
+
+def convert_chrom_job(args):
+    """
+    Convert one chromosome to out.chrom. Run in a worker process. 
+    """
+    file, chrom, offsets, options=args
+    convert_chrom(file, chrom, offsets, options, options.out+"."+chrom)
+    return chrom
+
+################################################################################
+
+def main(options):
+    """
+    Convert
+    """
+    if options.format!="vcf" and not options.out:
+        raise Exception("Must specify output root (-o) for "+options.format+" output")
+    if options.format=="counts" and not options.panel:
+        raise Exception("Must specify a panel (--panel) for counts")
+
+    seekable=options.input!="-" and not options.input.endswith(".gz")
+    if seekable and options.chrom:
+        index=chrom_index(options.input)
+        convert_chrom(options.input, options.chrom, index.get(options.chrom), options, options.out)
+    elif seekable and options.processes>1:
+        if not options.out:
+            raise Exception("Must specify output root (-o) to convert in parallel")
+        index=chrom_index(options.input)
+        chroms=sorted(index.keys(), key=lambda chrom:index[chrom][0])
+        pool=multiprocessing.Pool(options.processes)
+        for chrom in pool.imap(convert_chrom_job, [(options.input, chrom, index[chrom], options) for chrom in chroms]):
+            print("Converted chromosome "+chrom, file=sys.stderr)
+        pool.close()
+    else:
+        lines=sys.stdin if options.input=="-" else gdc.open2(options.input)
+        samples, columns=read_header(lines)
+        write_sites(samples, site_chunks(lines, columns, options), options, options.out)
+
+################################################################################
+
+def parse_block(lines, columns, options):
+    """
+    Parse a block of polysite lines, taking the alleles from columns, into a
+    chunk of sites like those of gdc.VCFReader: arrays CHROM, POS, ID, REF, 
+    ALT, GT (allele indices, MISSING for missing) and PHASED. Sites with no alt
+    alleles are dropped. Returns None if there are no sites. 
+    """
+    rows=[line.split() for line in lines]
+    if options.chrom:
+        rows=[bits for bits in rows if bits[0]==options.chrom]
+    if not rows:
+        return None
+    alleles=["".join([bits[i] for i in columns]) for bits in rows]
+    nsamples=len(alleles[0])
+    if any([len(x)!=nsamples for x in alleles]):
+        raise Exception("Different numbers of samples at different sites")
+    if not nsamples:
+        return None
+
+    codes=np.frombuffer("".join(alleles).encode("ascii"), dtype=np.uint8).reshape(len(rows), nsamples)
+    first=FIRST_ALLELE[codes]
+    second=SECOND_ALLELE[codes]
+    if not first.all():
+        raise Exception("Unknown genotype code "+chr(codes[first==0][0]))
+    ref=np.frombuffer("".join([bits[2][0] for bits in rows]).encode("ascii"), dtype=np.uint8)
+
+    #Which alt alleles each site has, and their numbers
+    has_alt=np.zeros((len(rows), len(ALT_ORDER)), dtype=bool)
+    for k, allele in enumerate(ALT_ORDER):
+        has_alt[:,k]=((first==ord(allele))|(second==ord(allele))).any(axis=1)&(ref!=ord(allele))
+    alt_number=np.cumsum(has_alt, axis=1)
+    alt_mask=has_alt.dot(1<<np.arange(len(ALT_ORDER)))
+    keep=np.flatnonzero(alt_mask)
+    if not len(keep):
+        return None
+
+    gt=np.empty((len(keep), nsamples, 2), dtype=np.int8)
+    for j, allele_bytes in enumerate([first[keep], second[keep]]):
+        index=np.where((allele_bytes==ref[keep,None])&(allele_bytes!=ord(".")), 0, gdc.MISSING)
+        for k, allele in enumerate(ALT_ORDER):
+            index=np.where((allele_bytes==ord(allele))&has_alt[keep,k,None], alt_number[keep,k,None], index)
+        gt[:,:,j]=index
+
+    chunk={"CHROM":np.array([rows[i][0] for i in keep]), "POS":np.array([int(rows[i][1]) for i in keep]), 
+           "REF":np.array([rows[i][2][0] for i in keep]), "ALT":np.array([ALT_STRINGS[x] for x in alt_mask[keep]])}
+    chunk["ID"]=np.array([rows[i][0]+"_"+rows[i][1] for i in keep])
+    chunk["GT"]=gt
+    chunk["PHASED"]=np.zeros(gt.shape[:2], dtype=bool)
+    return chunk
+
+################################################################################
+
+def vcf_lines(chunk):
+    """
+    The vcf lines of a chunk of sites, as one string
+    """
+    nsites, nsamples=chunk["GT"].shape[:2]
+    gts=np.empty((nsites, nsamples, 4), dtype=np.uint8)
+    gts[:,:,[0,2]]=np.where(chunk["GT"]>=0, ord("0")+chunk["GT"], ord("."))
+    gts[:,:,1]=ord("/")
+    gts[:,:,3]=ord("\t")
+    gts[:,-1,3]=ord("\n")
+    gt_strings=gts.reshape(nsites, 4*nsamples).view("S"+str(4*nsamples)).ravel().astype(str)
+
+    return "".join(["\t".join([chrom, pos, idd, ref, alt, "100", ".", ".", "GT", gts]) for chrom, pos, idd, ref, alt, gts in 
+                    zip(chunk["CHROM"].tolist(), chunk["POS"].astype(str).tolist(), chunk["ID"].tolist(), 
+                        chunk["REF"].tolist(), chunk["ALT"].tolist(), gt_strings.tolist())])
 
         
 ################################################################################
@@ -116,4 +360,3 @@ def main(options):
 if __name__=="__main__":
     options=parse_options()
     main(options)
-
@@ -15,10 +15,10 @@ def parse_options():
     out: root for .msmc output
     individuals: either 2 or 4 samples from the sample file. 
     """
-    options ={ "shapeit":None, "out":"out", "individuals":[], "psmc":False, "msmc": False }
+    options ={ "shapeit":None, "out":"out", "individuals":[], "psmc":False, "msmc": False, "bgzip":False }
 	
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "s:o:i:pm", ["shapeit", "out", "individuals", "psmc", "msmc"])
+        opts, args = getopt.getopt(sys.argv[1:], "s:o:i:pmz", ["shapeit", "out", "individuals", "psmc", "msmc", "bgzip"])
         print opts, args
     except Exception as err:
         print str(err)
@@ -31,6 +31,7 @@ def parse_options():
         elif o in ["-o","--out"]:         options["out"] = a
         elif o in ["-p","--psmc"]:        options["psmc"] = True
         elif o in ["-m","--msmc"]:        options["msmc"] = True
+        elif o in ["-z","--bgzip"]:       options["bgzip"] = True
 
     print "found options:"
     print options
@@ -5,9 +5,13 @@
 # removed multiallelic sites and indels
 # Deals with haploid cases including mixed haploid/diplod like X as well. 
 # -i option is a .ind file to get population names and sex. 
+# -p option writes a packed (PACKEDANCESTRYMAP) .geno file instead of text. 
+# -n option converts each chromosome in a separate process. The vcf must be 
+# bgzipped and tabix indexed. 
+# -z option bgzips the .snp and .geno files (text .geno only). 
 
 from __future__ import division
-import sys, getopt, gdc, pdb
+import sys, getopt, gdc, multiprocessing, os, shutil, pdb
 
 ################################################################################
 
@@ -15,10 +19,10 @@ def parse_options():
     """
     Options are described by the help() function
     """
-    options ={ "vcf":None, "out":"out", "ref":None, "indAsPop":False, "indmap":None  }
+    options ={ "vcf":None, "out":"out", "ref":None, "indAsPop":False, "indmap":None, "packed":False, "processes":1, "bgzip":False  }
 	
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "v:o:r:i:", ["vcf", "out", "ref", "indmap", "indAsPop"])
+        opts, args = getopt.getopt(sys.argv[1:], "v:o:r:i:pn:z", ["vcf", "out", "ref", "indmap", "indAsPop", "packed", "processes=", "bgzip"])
         print opts, args
     except Exception as err:
         print str(err)
@@ -30,8 +34,14 @@ def parse_options():
         if o in ["-r","--ref"]:         options["ref"] = a
         if o in ["-i","--ind"]:         options["indmap"] = a
         if o in ["--indAsPop"]:         options["indAsPop"] = True
+        if o in ["-p","--packed"]:      options["packed"] = True
+        if o in ["-n","--processes"]:   options["processes"] = int(a)
+        if o in ["-z","--bgzip"]:       options["bgzip"] = True
         elif o in ["-o","--out"]:       options["out"] = a
 
+    if options["packed"] and options["bgzip"]:
+        raise Exception("Can't bgzip packed .geno files")
+
     print "found options:"
     print options
     return options
@@ -42,60 +52,18 @@ def main(options):
     """
     Convert vcf to eigenstrat format (ind, snp and geno files)
     """
-    vcf=gdc.open2(options["vcf"])
-    snp, ind, geno = [open(options["out"]+x, "w") for x in [".snp", ".ind", ".geno"]]
-    removed={"multiallelic":0, "indel":0}
-    count=0
-    
-    if options["indmap"]:
-        pop_map={}
-        sex_map={}
-        ind_map_file=open(options["indmap"], "r")
-        for line in ind_map_file:
-            bits=line[:-1].split()
-            pop_map[bits[0]]=bits[2]
-            sex_map[bits[0]]=bits[1]
-        ind_map_file.close()
-    
-    for line in vcf:
-        if line[:2]=="##":				  # Comment line
-            next
-        elif line[:6]=="#CHROM":			  # Header line
-            inds=line.split()[9:]
-            if options["ref"]:
-                ind.write(options["ref"]+"\tU\tREF\n")
-            
-            if options["indmap"]:
-                for indi in inds:
-                    ind.write(indi+"\t"+sex_map.get(indi, "U")+"\t"+pop_map.get(indi, "POP")+"\n")
-            elif options["indAsPop"]:
-                for indi in inds:
-                    ind.write(indi+"\tU\t"+indi+"\n")
-            else:
-                for indi in inds:
-                    ind.write(indi+"\tU\tPOP\n")
-                   
-        else:							  # data
-            bits=line.split()
-            if "," in bits[4]:
-                removed["indel"]+=1
-                continue
-            if len(bits[3])!=1 or len(bits[4])!=1:
-                removed["multiallelic"]+=1
-                continue
-            else:
-                if bits[2]==".":
-                    bits[2]=bits[0]+":"+bits[1]
-                snp.write("    ".join([bits[2], bits[0], "0.0", bits[1], bits[3], bits[4]])+"\n")
-                geno_string=""
-                if options["ref"]:
-                    geno_string="2"
-                for gt in bits[9:]:
-                    geno_string+=decode_gt_string(gt)
-                geno.write(geno_string+"\n")
-                count+=1
-
-    [f.close for f in [ind, snp, geno]]
+    vcf=gdc.VCFReader(options["vcf"])
+    inds=vcf.samples
+    gdc.write_ind(options["out"], inds, options["ref"], options["indmap"], options["indAsPop"])
+    if options["ref"]:
+        inds=[options["ref"]]+inds
+
+    if options["processes"]>1:
+        vcf.close()
+        count, removed=convert_parallel(inds, options)
+    else:
+        count, removed=gdc.write_eigenstrat(vcf, options["out"], inds, bool(options["ref"]), options["packed"], options["bgzip"])
+        vcf.close()
 
     print "Done. Wrote "+str(count) + " sites"
     print "Excluded " + str(sum(removed.values())) + " sites"
@@ -105,32 +73,61 @@ def main(options):
 
 ################################################################################
 
-def decode_gt_string(gt_string):
+def convert_shard(args):
     """
-    Tries to work out the genotype from a vcf genotype entry. 9 for missing [or not in {0,1,2}]
+    Convert one chromosome of a tabix indexed vcf. Run in a worker process. 
     """
-    gt=gt_string.split(":")[0]
-    if len(gt)==1:
-        if gt=="0":                       # haploid
-            return "2"
-        elif gt=="1":
-            return "0"
-        else:
-            return "9"
-    elif len(gt)==3:
-        if gt[0]=="0" and gt[2]=="0":
-            return "2"
-        if gt[0]=="0" and gt[2]=="1":
-            return "1"
-        if gt[0]=="1" and gt[2]=="0":
-            return "1"
-        if gt[0]=="1" and gt[2]=="1":
-            return "0"
+    chrom, out, inds, options=args
+    return gdc.write_eigenstrat(gdc.VCFReader(options["vcf"], region=chrom), out, inds, bool(options["ref"]), options["packed"], options["bgzip"])
+
+################################################################################
+
+def convert_parallel(inds, options):
+    """
+    Convert each chromosome of a bgzipped, tabix indexed vcf in a separate
+    process, then concatenate the .snp and .geno shards in the order of the
+    chromosomes in the index. 
+    """
+    chroms=gdc.tabix_contigs(options["vcf"])
+    shards=[options["out"]+".part"+str(i) for i in range(len(chroms))]
+    pool=multiprocessing.Pool(options["processes"])
+    results=pool.map(convert_shard, [(chrom, shard, inds, options) for chrom, shard in zip(chroms, shards)])
+    pool.close()
+
+    suffix=".gz" if options["bgzip"] else ""
+    snp=open(options["out"]+".snp"+suffix, "wb")
+    if options["packed"]:
+        geno=gdc.PackedGenoWriter(options["out"]+".geno", inds)
+    else:
+        geno=open(options["out"]+".geno"+suffix, "wb")
+
+    # bgzipped shards can be concatenated as they are
+    for shard in shards:
+        if options["packed"]:
+            geno.append(shard+".geno", [x.split(None, 1)[0] for x in open(shard+".snp")])
+            os.remove(shard+".geno")
         else:
-            return "9"
+            append_shard(geno, shard+".geno"+suffix)
+        append_shard(snp, shard+".snp"+suffix)
+    [f.close() for f in [snp, geno]]
+
+    count=sum([x[0] for x in results])
+    removed={"multiallelic":0, "indel":0}
+    for key in removed:
+        removed[key]=sum([x[1][key] for x in results])
+    return count, removed
+
+################################################################################
+
+def append_shard(out, shard):
+    """
+    Copy a shard to the end of out and delete it. 
+    """
+    shard_file=open(shard, "rb")
+    shutil.copyfileobj(shard_file, out)
+    shard_file.close()
+    os.remove(shard)
 
-    raise Exception("Unknown genotype: "+gt)
-        
 ################################################################################
 
 if __name__=="__main__":
@@ -1,13 +1,22 @@
 #Given a vcf and a panel file, export a frequency file with N+5 columns and M+1 rows
 # N populations and M SNPs - one header row and the first 5 columns are 
 #SNPID, CHR, POS, REF, alter_code1
+#-n counts blocks of sites on several processes, in input order, so works on piped input
+#-o out writes the alt and total allele counts of each population at every site as 
+#nsite x npop int32 arrays, out.alt.npy and out.total.npy, with the sites in out.sites 
+#and the populations in out.pops. -c out turns those back into the text output. 
+#-m merges binary counts into -o out. With -a regions (e.g. one per chromosome, made 
+#with -r) they are concatenated, and with -a samples (the same sites in different 
+#batches of samples) the counts of each population are summed.
+#-s file also writes statistics in windows of -w bp (or snps, with -u snps) from the same
+#counts: mean unbiased heterozygosity and the fraction of missing genotypes of each 
+#population, and Hudson's Fst (ratio of averages) for each pair. The vcf must be sorted. 
 
 from __future__ import division, print_function
-from collections import defaultdict
-import argparse, sys
+import argparse, collections, filecmp, multiprocessing, sys, gdc
+import numpy as np
 import pdb
 
-
 ################################################################################
 
 def parse_options():
@@ -15,66 +24,310 @@ def parse_options():
     Try using argparse
     """
     parser=argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', type=argparse.FileType('r'), default="-")
+    parser.add_argument('-i', '--input', type=str, default="-", help=
+                        "vcf file, or - for stdin")
+    parser.add_argument('-r', '--region', type=str, default=None, help=
+                        "Only count this chromosome (or chrom:start-end, if the vcf is tabix indexed)")
     parser.add_argument('-p', '--panel', type=str, action="store", default=None, help=
                         "Two column file mapping IDs to populations")
+    parser.add_argument('-n', '--processes', type=int, default=1, help=
+                        "Number of processes counting blocks of sites")
+    parser.add_argument('-o', '--out', type=str, default=None, help=
+                        "Write binary counts to out.alt.npy, out.total.npy, out.sites and out.pops")
+    parser.add_argument('-c', '--counts', type=str, default=None, help=
+                        "Write the text output from binary counts written with -o counts")
+    parser.add_argument('-m', '--merge', type=str, nargs="+", default=None, help=
+                        "Merge these binary counts into -o out")
+    parser.add_argument('-a', '--axis', type=str, choices=["regions", "samples"], default="regions", help=
+                        "Merge shards of different regions (concatenate) or different samples (sum)")
+    parser.add_argument('-s', '--stats', type=str, default=None, help=
+                        "Also write heterozygosity, missingness and pairwise Fst in windows to this file")
+    parser.add_argument('-w', '--window', type=int, default=100000, help=
+                        "Window size for --stats")
+    parser.add_argument('-u', '--window_unit', type=str, choices=["bp", "snps"], default="bp", help=
+                        "Whether the window size is in bp or snps")
 
     return parser.parse_args()
 
 ################################################################################
 
-def read_panel(panel_file):
+def freq_lines(cols, counts, totals):
+    """
+    The output lines for a block of sites, as one string. Sites where any 
+    population has no called alleles are dropped. 
+    """
+    keep=(totals>0).all(axis=1)
+    if not keep.any():
+        return ""
+    freqs=counts[keep]/totals[keep]
+    cols=[cols[i] for i in np.flatnonzero(keep)]
+    return "".join(["\t".join(list(col)+["%1.4f" % x for x in row])+"\n" for col, row in zip(cols, freqs.tolist())])
+
+################################################################################
+
+def site_stats(counts, totals, missing):
+    """
+    Statistics of each site, to be summed over windows: the unbiased expected 
+    heterozygosity of each population and whether it's defined (at least two 
+    called alleles), the number of missing genotypes of each population, and 
+    the numerator and denominator of Hudson's Fst for each pair of populations.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        freqs=np.where(totals>0, counts/totals, 0)
+        ok=totals>1
+        het=np.where(ok, 2*freqs*(1-freqs)*totals/(totals-1), 0)
+        pi=np.where(ok, freqs*(1-freqs)/(totals-1), 0)
+    i, j=np.triu_indices(counts.shape[1], 1)
+    pair_ok=ok[:,i]&ok[:,j]
+    num=np.where(pair_ok, (freqs[:,i]-freqs[:,j])**2-pi[:,i]-pi[:,j], 0)
+    den=np.where(pair_ok, freqs[:,i]*(1-freqs[:,j])+freqs[:,j]*(1-freqs[:,i]), 0)
+    return [het, ok.astype(int), missing, num, den]
+
+################################################################################
+
+def process_chunk(chunk, pop_idx, npops, binary, stats=False):
+    """
+    Count a chunk of vcf records. Returns the output lines, or for binary 
+    output the site table lines and the alt and total count arrays. With 
+    stats, also returns the chromosomes, positions and site_stats. 
+    """
+    counts, totals=gdc.count_alleles(chunk["GT"], pop_idx, npops)
+    cols=gdc.site_cols(chunk)
+    if binary:
+        result="".join(["\t".join(col)+"\n" for col in cols]), counts, totals
+    else:
+        result=freq_lines(cols, counts, totals)
+    if stats:
+        missing=gdc.pop_sums((chunk["GT"][:,:,0]==gdc.MISSING).astype(int), pop_idx, npops)
+        return result, (chunk["CHROM"], chunk["POS"], site_stats(counts, totals, missing))
+    return result
+
+################################################################################
+
+def freq_block(args):
+    """
+    Parse and count a block of vcf lines. Run in a worker process. 
     """
-    Open the panel file and return a dictionary that maps sample to popuation
+    lines, sample_idx, pop_idx, npops, binary, stats=args
+    return process_chunk(gdc.parse_records(lines, sample_idx), pop_idx, npops, binary, stats)
+
+################################################################################
+
+class WindowStats(object):
     """
-    map={}
-    pf=open(panel_file, "r")
-    for line in pf:
-        bits=line.split()
-        map[bits[0]]=bits[1]
+    Sum site_stats over windows of size bp, or size snps if snps, and write 
+    each window's heterozygosity and missingness of each population, and Fst 
+    of each pair of populations, to file. Windows don't span chromosomes, and 
+    the sites must be sorted. 
+    """
+    def __init__(self, file, pops, pop_sizes, size, snps=False):
+        self.out=gdc.open2(file, "w")
+        self.pop_sizes=pop_sizes
+        self.size=size
+        self.snps=snps
+        pairs=zip(*np.triu_indices(len(pops), 1))
+        self.out.write("\t".join(["CHR", "START", "END", "NSITES"]+["HET_"+pop for pop in pops]+["MISS_"+pop for pop in pops]+
+                                 ["FST_"+pops[i]+"_"+pops[j] for i, j in pairs])+"\n")
+        self.window=None
+        self.chrom=None
+        self.chrom_sites=0
         
-    pops=list(set(map.values())) 
-    pops.sort()   
-    
-    return map, pops
+    def add(self, chrom, pos, stats):
+        """
+        Add the site_stats of sites at chrom and pos. 
+        """
+        #Start of each run of the same chromosome, and the window of each site
+        new_chrom=np.concatenate([[self.chrom is None or chrom[0]!=self.chrom], chrom[1:]!=chrom[:-1]])
+        if self.snps:
+            #Sites before the first new chromosome carry on from the last chunk
+            runs=np.flatnonzero(new_chrom)
+            run=np.searchsorted(runs, np.arange(len(pos)), side="right")-1
+            index=np.arange(len(pos))-np.where(run>=0, np.append(runs, 0)[run], -self.chrom_sites)
+            window=index//self.size
+            self.chrom_sites=index[-1]+1
+        else:
+            window=(pos-1)//self.size
+        self.chrom=chrom[-1]
+        
+        starts=np.flatnonzero(new_chrom|np.concatenate([[True], window[1:]!=window[:-1]]))
+        sums=[np.add.reduceat(x, starts, axis=0) for x in stats]
+        ends=np.append(starts[1:], len(pos))
+        for k, (start, end) in enumerate(zip(starts, ends)):
+            key=(chrom[start], window[start])
+            if key!=self.window:
+                self.flush()
+                self.window=key
+                self.first=pos[start]
+                self.nsites=0
+                self.sums=[np.zeros(x.shape[1]) for x in sums]
+            self.last=pos[end-1]
+            self.nsites+=end-start
+            for total, x in zip(self.sums, sums):
+                total+=x[k]
+
+    def flush(self):
+        """
+        Write the current window, if there is one. 
+        """
+        if self.window is None:
+            return
+        chrom, window=self.window
+        het, het_sites, missing, num, den=self.sums
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats=np.concatenate([het/het_sites, missing/(self.nsites*self.pop_sizes), num/den])
+        if self.snps:
+            start, end=self.first, self.last
+        else:
+            start, end=window*self.size+1, (window+1)*self.size
+        self.out.write("\t".join([chrom, str(start), str(end), str(self.nsites)]+
+                                 ["NA" if np.isnan(x) else "%1.6f" % x for x in stats])+"\n")
+        self.window=None
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+################################################################################
+
+def count_blocks(counts):
+    """
+    Generate the binary counts written to counts.* in blocks of CHUNK_SIZE 
+    sites, as the site table lines and alt and total count arrays.
+    """
+    alt=np.load(counts+".alt.npy", mmap_mode="r")
+    total=np.load(counts+".total.npy", mmap_mode="r")
+    sites=open(counts+".sites")
+    sites.readline()
+    lines=[]
+    start=0
+    for line in sites:
+        lines.append(line)
+        if len(lines)==gdc.CHUNK_SIZE:
+            yield lines, alt[start:start+len(lines)], total[start:start+len(lines)]
+            start+=len(lines)
+            lines=[]
+    if lines:
+        yield lines, alt[start:start+len(lines)], total[start:start+len(lines)]
+    sites.close()
+
+################################################################################
+
+def read_pops(counts):
+    """
+    The populations of binary counts
+    """
+    return [line.strip() for line in open(counts+".pops")]
+
+################################################################################
+
+def read_counts(counts):
+    """
+    Write the text output from the binary counts written to counts.* 
+    """
+    print("\t".join(gdc.SITE_COLS+read_pops(counts)))
+    for lines, alt, total in count_blocks(counts):
+        cols=[tuple(line[:-1].split("\t")) for line in lines]
+        sys.stdout.write(freq_lines(cols, alt, total))
+
+################################################################################
+
+def merge_counts(shards, axis, out):
+    """
+    Merge binary counts. Shards of different regions with the same populations
+    are concatenated, in the order given. Shards of different samples with the 
+    same sites are summed, by population. 
+    """
+    shard_pops=[read_pops(shard) for shard in shards]
+    if axis=="regions":
+        if any([pops!=shard_pops[0] for pops in shard_pops]):
+            raise Exception("Can only merge regions with the same populations")
+        writer=gdc.CountsWriter(out, shard_pops[0])
+        for shard in shards:
+            for lines, alt, total in count_blocks(shard):
+                writer.write(("".join(lines), alt, total))
+    elif axis=="samples":
+        for shard in shards[1:]:
+            if not filecmp.cmp(shards[0]+".sites", shard+".sites", shallow=False):
+                raise Exception("Can only merge samples with the same sites: "+shard)
+        pops=sorted(set(sum(shard_pops, [])))
+        pop_cols=[[pops.index(pop) for pop in shard_pop] for shard_pop in shard_pops]
+        writer=gdc.CountsWriter(out, pops)
+        blocks=[count_blocks(shard) for shard in shards]
+        for block in blocks[0]:
+            lines=block[0]
+            alt=np.zeros((len(lines), len(pops)), dtype=np.int32)
+            total=np.zeros((len(lines), len(pops)), dtype=np.int32)
+            for cols, (other_lines, other_alt, other_total) in zip(pop_cols, [block]+[next(x) for x in blocks[1:]]):
+                alt[:,cols]+=other_alt
+                total[:,cols]+=other_total
+            writer.write(("".join(lines), alt, total))
+    else:
+        raise Exception("Unknown merge axis "+axis)
+    writer.close()
+
+################################################################################
+
+def write_result(result, out, windows):
+    """
+    Write the result of process_chunk to out, and add its stats to windows
+    """
+    if windows:
+        result, sites=result
+        windows.add(*sites)
+    out.write(result)
 
 ################################################################################
 
 def main(options):
     """
-    run through the file and output to stdout. 
+    run through the file and output to stdout, or to binary counts. 
     """
-    map, pops=read_panel(options.panel)
-    print("\t".join(["SNPID", "CHR", "POS", "REF", "ALT"]+pops))
+    if options.counts:
+        read_counts(options.counts)
+        return
+    if options.merge:
+        if not options.out:
+            raise Exception("Must specify output (-o) to merge")
+        merge_counts(options.merge, options.axis, options.out)
+        return
+
+    map, pops=gdc.read_panel(options.panel)
+    binary=bool(options.out)
+    if binary:
+        out=gdc.CountsWriter(options.out, pops)
+    else:
+        print("\t".join(gdc.SITE_COLS+pops))
+        out=sys.stdout
     
-    samples=[]
-    for line in options.input:
-        if line.startswith("##"):
-            pass
-        elif line.startswith("#"): #Header line
-            samples=line.split()[9:]
-        else: #This is a data line. 
-            counts=defaultdict(int)
-            totals=defaultdict(int)
-            bits=line.split()
-            first_cols=[bits[2], bits[0], bits[1], bits[3], bits[4]]
-            for i in range(9, len(bits)):
-                if samples[i-9] not in map:
-                    continue
-                for j in [0,1]:
-                    if bits[i][j]=="0":
-                        totals[map[samples[i-9]]]+=1
-                    if bits[i][j]=="1":
-                        counts[map[samples[i-9]]]+=1
-                        totals[map[samples[i-9]]]+=1
-            
-            freqs=[0.0]*len(pops)
-            try:
-                for i,pop in enumerate(pops):
-                    freqs[i]=counts[pop]/totals[pop]
-                print("\t".join(first_cols+[format(x, "1.4f") for x in freqs]))
-            except ZeroDivisionError:
-                continue
+    vcf=gdc.VCFReader(sys.stdin if options.input=="-" else options.input, region=options.region)
+    samples, pop_idx=gdc.pop_index(vcf.samples, map, pops)
+    vcf.select(samples)
+    stats=bool(options.stats)
+    windows=None
+    if stats:
+        windows=WindowStats(options.stats, pops, np.bincount(pop_idx, minlength=len(pops)), 
+                            options.window, options.window_unit=="snps")
+    if options.processes>1:
+        #Blocks of lines are parsed and counted by the pool. The results are 
+        #written in the order they were read, with at most 2 blocks per 
+        #process in flight. 
+        pool=multiprocessing.Pool(options.processes)
+        pending=collections.deque()
+        for block in vcf.blocks():
+            pending.append(pool.apply_async(freq_block, ((block, vcf.sample_idx, pop_idx, len(pops), binary, stats),)))
+            if len(pending)>=2*options.processes:
+                write_result(pending.popleft().get(), out, windows)
+        while pending:
+            write_result(pending.popleft().get(), out, windows)
+        pool.close()
+    else:
+        for chunk in vcf:
+            write_result(process_chunk(chunk, pop_idx, len(pops), binary, stats), out, windows)
+
+    if binary:
+        out.close()
+    if stats:
+        windows.close()
     
 ################################################################################
 
@@ -1,13 +1,26 @@
 # Convert a vcf file to hetfa format
 # To make psmc output, use the fq2psmcfa program from the utils folder of the psmc directory: 
 # vcf2hetfa.py -v vcf -r ref -s sample -c chrom | fold | fq2psmcfa - > sample.psmcfa
+# -s can also be a comma separated list of samples, or "all", in which case 
+# there is one output file per sample, out.sample.hetfa.fa.gz 
+# -p writes psmcfa (as fq2psmcfa would make from the hetfa) instead of hetfa
+# Without -c, converts every chromosome in the reference .fai, each in a separate
+# process (-n of them at once), and joins the outputs in reference order unless
+# --separate is given, in which case they are out.chrom[.sample].hetfa.fa.gz
+# This is much faster if the vcf is bgzipped and tabix indexed. 
+# The mask (-m) is read through a run-length index, saved next to it as
+# mask.fa.rle.npz the first time the mask is used. 
 
 from __future__ import division, print_function
-import sys, getopt, gdc, gzip
-from pyfaidx import Fasta
+import sys, getopt, gdc, multiprocessing, os, shutil
+import numpy as np
 import pdb
 
 HETFA_MAP={("A","A"):"A", ("C","C"):"C", ("G", "G"):"G", ("T","T"):"T", ("A", "C"):"M", ("A","G"):"R", ("A","T"):"W", ("C","G"):"S", ("C", "T"):"Y", ("G","T"):"K"}
+# HETFA_MAP as a lookup table on the bytes of the two alleles, either way round
+HETFA_CODES=np.zeros((256,256), dtype=np.uint8)
+for (a,b),code in HETFA_MAP.items():
+    HETFA_CODES[ord(a),ord(b)]=HETFA_CODES[ord(b),ord(a)]=ord(code)
 
 
 ################################################################################
@@ -18,11 +31,12 @@ def parse_options():
     """
     options ={ "vcf":None, "out":None, "ref":None, "haplotypes":False, 
               "sample":None, "chrom":None, "refcheck" :True, "mask":None,
-              "mask_value":None, "haploid":False }
+              "mask_value":None, "psmcfa":False, "processes":1, "separate":False }
 	
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "v:o:r:s:c:m:a:h", 
-                                   ["vcf", "out", "ref", "sample", "chrom", "mask", "mask_value", "haplotypes"])
+        opts, args = getopt.getopt(sys.argv[1:], "v:o:r:s:c:m:a:hpn:", 
+                                   ["vcf", "out", "ref", "sample", "chrom", "mask", "mask_value", "haplotypes", "psmcfa",
+                                    "processes=", "separate"])
     except Exception as err:
         print(str(err), file=sys.stderr)
         sys.exit()
@@ -35,6 +49,9 @@ def parse_options():
         elif o in ["-m","--mask"]:        options["mask"] = a
         elif o in ["-a","--mask_value"]:  options["mask_value"] = int(a)
         elif o in ["-h","--haplotypes"]:  options["haplotypes"] = True
+        elif o in ["-p","--psmcfa"]:      options["psmcfa"] = True
+        elif o in ["-n","--processes"]:   options["processes"] = int(a)
+        elif o in ["--separate"]:         options["separate"] = True
         elif o in ["-o","--out"]:       options["out"] = a
         
     if bool(options["mask"])!=bool(options["mask_value"]):
@@ -42,6 +59,9 @@ def parse_options():
         
     if options["haplotypes"] and not options["out"]:
         raise Exception("Must specify output file if using haplotypes")
+
+    if not options["chrom"] and not options["out"]:
+        raise Exception("Must specify output file if converting all chromosomes")
         
     print("found options:", file=sys.stderr)
     print(options, file=sys.stderr) 
@@ -49,176 +69,312 @@ def parse_options():
 
 ################################################################################
 
-def get_ref_seq(options, ref_fa, mask, last_pos, pos):
+def load_ref(options):
     """
-    Extract and mask the reference sequence. Replace masked regions with N
+    Load the reference for the chromosome as a byte array, and the mask as 
+    runs from its index
     """
-    ref_seq=ref_fa[options["chrom"]][last_pos:(pos-1)].seq
-    if mask:
-        mask_seq=mask[options["chrom"]][last_pos:(pos-1)].seq
-        ref_seq="".join([x if y!="N" and int(y) >= options["mask_value"] else "N" for x,y in zip(ref_seq, mask_seq)])
-    return ref_seq
+    ref=gdc.load_fasta(options["ref"], options["chrom"])
+    mask=None
+    if options["mask"]:
+        mask=gdc.MaskIndex(options["mask"])[options["chrom"]]
+        if len(mask)!=len(ref):
+            raise Exception("Mask is a different length to the reference")
+    return ref, mask
 
-################################################################################                                                                             
+################################################################################
 
-def check_mask(mask, options, pos):
+def mask_table(options):
     """
-    Check the mask for a single postion. Return True if masked and False if ok. 
+    Lookup table from mask bytes to whether a site is masked (below 
+    mask_value; N does not mask sites). 
     """
-    masked=False
-    
-    if mask:
-        mask_chr=mask[options["chrom"]][pos-1].seq
-        if mask_chr!="N" and int(mask_chr) < options["mask_value"]:
-            masked=True
+    masked=np.zeros(256, dtype=bool)
+    if options["mask"]:
+        masked[ord("0"):ord("9")+1]=np.arange(10)<options["mask_value"]
     return masked
-        
+
 ################################################################################
 
-def output_fastas(options):
+def get_ref_seq(ref, mask, start, end, options):
+    """
+    Extract and mask the reference sequence from start to end (0-based). Replace
+    masked regions (below mask_value, or not a digit) with N. Always returns a 
+    copy. 
     """
-    output two .fa files, one for each chromosome. 
+    seq=ref[start:end].copy()
+    if mask is not None:
+        for mask_start, mask_end in mask.masked_intervals(start, end, options["mask_value"]):
+            seq[mask_start-start:mask_end-start]=ord("N")
+    return seq
+
+################################################################################
+
+def get_sites(chunk, last_pos, ref, mask, options):
     """
-    ref_fa=Fasta(options["ref"])
+    Pick the sites to use from a chunk of vcf records - the first record at each
+    position. Returns their positions and genotypes, the REF and ALT bases, and
+    for each sample whether the site can be called - a biallelic snp that is 
+    not masked - and whether it is phased. 
+    """
+    pos=chunk["POS"]
+    used=pos!=np.concatenate([[last_pos], pos[:-1]])
+    pos=pos[used]
+    gt=chunk["GT"][used]
+    ref_base=chunk["REF"][used].astype("S1").view(np.uint8)
+    alt_base=chunk["ALT"][used].astype("S1").view(np.uint8)
 
-    out0=gzip.open(options["out"]+".0.fa.gz", "w")
-    out1=gzip.open(options["out"]+".1.fa.gz", "w")
-    out0.write(">"+options["chrom"]+"\n")
-    out1.write(">"+options["chrom"]+"\n")
+    snp=(np.char.str_len(chunk["REF"][used])==1)&(np.char.str_len(chunk["ALT"][used])==1)
+    if mask is not None:
+        snp&=~mask_table(options)[mask.at(pos-1)]
+    called=snp[:,None]&((gt==0)|(gt==1)).all(axis=2)
 
-    mask=None
-    if options["mask"]:
-        mask=Fasta(options["mask"])
+    #This is the sequence from the last position to the base before the current position (note that pos is 1-based)
+    if options["refcheck"]:
+        mismatch=called.any(axis=1)&(ref[pos-1]!=ref_base)
+        if mismatch.any():
+            raise Exception("Reference mismatch at pos "+str(pos[mismatch][0]))
 
-    vcf=gdc.open2(options["vcf"])
-    sample_idx=None
-    last_pos=0
-    for line in vcf:
-        if line.startswith("##"):
-            continue
-        elif line.startswith("#"):
-            bits=line.split()
-            sample_idx=bits.index(options["sample"])
-        else: #data line
-            bits=line.split()
-            gt=bits[sample_idx]
-            pos=int(bits[1])
-            if pos==last_pos:
+    return pos, gt, ref_base, alt_base, called, chunk["PHASED"][used]
+
+################################################################################
+
+def get_samples(vcf, options):
+    """
+    The samples to output: a comma separated list, or all the samples in the vcf. 
+    Restricts the vcf reader to these samples. 
+    """
+    if options["sample"]=="all":
+        samples=vcf.samples
+    else:
+        samples=options["sample"].split(",")
+    if len(samples)>1 and not options["out"]:
+        raise Exception("Must specify output file if using several samples")
+    vcf.select(samples)
+    return samples
+
+################################################################################
+
+def sample_file(options, samples, sample, suffix):
+    """
+    Output file name for a sample. The sample name is only added if there are 
+    several samples. 
+    """
+    if len(samples)>1:
+        return options["out"]+"."+sample+suffix
+    return options["out"]+suffix
+
+################################################################################
+
+def output_fastas(options):
+    """
+    output two .fa files for each sample, one for each chromosome. 
+    """
+    ref, mask=load_ref(options)
+    vcf=gdc.VCFReader(options["vcf"], region=options.get("region") or options["chrom"])
+    samples=get_samples(vcf, options)
+
+    outs=[]
+    files=[]
+    for sample in samples:
+        for hap in [0,1]:
+            files.append(sample_file(options, samples, sample, "."+str(hap)+".fa.gz"))
+            out=gdc.open2(files[-1], "w")
+            out.write(">"+options["chrom"]+"\n")
+            outs.append(out)
+
+    try:
+        last_pos=0
+        for chunk in vcf:
+            pos, gt, ref_base, alt_base, called, phased=get_sites(chunk, last_pos, ref, mask, options)
+            if not len(pos):
                 continue
-            ref=bits[3]
-            alt=bits[4]
-
-            masked=check_mask(mask, options, pos)
-            ref_seq=get_ref_seq(options, ref_fa, mask, last_pos, pos)
-            
-            if len(ref)==1 and len(alt)==1 and gt in ["0|0", "1|0", "0|1", "1|1"] and not masked: #This is a phased biallelic site
-                #This is the sequence from the last position to the base before the current position (note that pos is 1-based)
-                if options["refcheck"] and ref_fa[options["chrom"]][pos-1].seq!=ref:
-                    raise Exception("Reference mismatch at pos "+str(pos))
-                
-                if gt[0]=="0":
-                    out0.write(ref_seq+ref)
-                elif gt[0]=="1":
-                    out0.write(ref_seq+alt)
-                else:
-                    raise Exception("Untrapped bad genotype in haplotype 0 at pos"+str(pos))
-                
-                if gt[2]=="0":
-                    out1.write(ref_seq+ref)
-                elif gt[2]=="1":
-                    out1.write(ref_seq+alt)
-                else:
-                    raise Exception("Untrapped bad genotype in haplotype 1 at pos"+str(pos))
-                
-            else:   #This is either unphased or missing or multiallelic
-                out0.write(ref_seq+"N")
-                out1.write(ref_seq+"N")
-            
-            last_pos=pos
-
-    #Fill in the reference at the end and terminate with newline. 
-    tail_seq=ref_fa[options["chrom"]][last_pos:].seq
-    out0.write(tail_seq+"\n")
-    out1.write(tail_seq+"\n")
-    out0.close()
-    out1.close()
+            #Phased biallelic sites get the allele on each haplotype, anything else is N.
+            #The masked reference is shared by all the outputs, which only differ at the sites.
+            called&=phased
+            seq=get_ref_seq(ref, mask, last_pos, pos[-1], options)
+            for i,out in enumerate(outs):
+                codes=np.where(gt[:,i//2,i%2]==0, ref_base, alt_base)
+                codes[~called[:,i//2]]=ord("N")
+                seq[pos-1-last_pos]=codes
+                out.write(seq.tobytes())
+            last_pos=pos[-1]
+
+        #Fill in the reference at the end and terminate with newline. 
+        tail_seq=get_ref_seq(ref, mask, last_pos, len(ref), options).tobytes()
+        for out in outs:
+            out.write(tail_seq+"\n")
+            out.close()
+    except:
+        discard(outs, files)
+        raise
+    return files
 
 ################################################################################
 
 def output_hetfa(options):
     """
-    output a single hetfa 
+    output a hetfa, or psmcfa, for each sample 
     """
-    ref_fa=Fasta(options["ref"])
-    mask=None
-    if options["mask"]:
-        mask=Fasta(options["mask"])
+    ref, mask=load_ref(options)
+    vcf=gdc.VCFReader(options["vcf"], region=options.get("region") or options["chrom"])
+    samples=get_samples(vcf, options)
                
-    out=None
-    if options["out"]:    
-        out=gzip.open(options["out"]+".hetfa.fa.gz", "w")
+    outs=[]
+    files=[]
+    if options["out"] and options["psmcfa"]:
+        files=[sample_file(options, samples, sample, ".psmcfa") for sample in samples]
+        outs=[gdc.PsmcfaWriter(gdc.open2(x, "w")) for x in files]
+    elif options["out"]:    
+        files=[sample_file(options, samples, sample, ".hetfa.fa.gz") for sample in samples]
+        outs=[gdc.open2(x, "w") for x in files]
+    elif options["psmcfa"]:
+        outs=[gdc.PsmcfaWriter(sys.stdout)]
     else: 
-        out=sys.stdout
+        outs=[sys.stdout]
         
-    out.write(">"+options["chrom"]+"\n")
-    
-    vcf=gdc.open2(options["vcf"])
-    sample_idx=None
-    last_pos=0
-    for line in vcf:
-        if line.startswith("##"):
-            continue
-        elif line.startswith("#"):
-            bits=line.split()
-            sample_idx=bits.index(options["sample"])
-        else: #data line
-            bits=line.split()
-            gt=bits[sample_idx]
-            pos=int(bits[1])
-            if pos==last_pos:
+    try:
+        for out in outs:
+            out.write(">"+options["chrom"]+"\n")
+        
+        last_pos=0
+        for chunk in vcf:
+            pos, gt, ref_base, alt_base, called, phased=get_sites(chunk, last_pos, ref, mask, options)
+            if not len(pos):
                 continue
-            ref=bits[3]
-            alt=bits[4]
-
-            masked=check_mask(mask, options, pos)
-            ref_seq=get_ref_seq(options, ref_fa, mask, last_pos, pos)
-            
-            if len(ref)==1 and len(alt)==1 and gt[0] in ["0","1"] and gt[2] in ["0","1"] and not masked: #This is a biallelic site
-                #This is the sequence from the last position to the base before the current position (note that pos is 1-based)
-                if options["refcheck"] and ref_fa[options["chrom"]][pos-1].seq!=ref:
-                    raise Exception("Reference mismatch at pos "+str(pos))
-                
-                genotype=int(gt[0])+int(gt[2])
-                if genotype==0:
-                    out.write(ref_seq+ref)
-                elif genotype==1:
-                    hetfa_code=HETFA_MAP[tuple(sorted([ref,alt]))]
-                    out.write(ref_seq+hetfa_code)
-                elif genotype==2:
-                    out.write(ref_seq+alt)
-                else:
-                    raise Exception("Untrapped bad genotype in haplotype 0 at pos"+str(pos))
-                                
-            else:   #This is either unphased or missing or multiallelic
-                out.write(ref_seq+"N")
-                
-            last_pos=pos
-
-    #Fill in the reference at the end and terminate with newline. 
-    tail_seq=ref_fa[options["chrom"]][last_pos:].seq
-    out.write(tail_seq+"\n")
+            #The masked reference is shared by all the outputs, which only differ at the sites.
+            seq=get_ref_seq(ref, mask, last_pos, pos[-1], options)
+            for i,out in enumerate(outs):
+                seq[pos-1-last_pos]=hetfa_codes(gt[:,i], ref_base, alt_base, called[:,i])
+                out.write(seq.tobytes())
+            last_pos=pos[-1]
+
+        #Fill in the reference at the end and terminate with newline. 
+        tail_seq=get_ref_seq(ref, mask, last_pos, len(ref), options).tobytes()
+        for out in outs:
+            out.write(tail_seq+"\n")
+            if options["out"]:
+                out.close()
+    except:
+        discard(outs, files)
+        raise
+    return files
+
+################################################################################
+
+def discard(outs, files):
+    """
+    Close and delete the output files of a chromosome that failed part way, 
+    so only complete outputs are left. Nothing is deleted when writing to 
+    stdout. 
+    """
+    if not files:
+        return
+    for out in outs:
+        try:
+            out.close()
+        except Exception:
+            pass
+    for file in files:
+        if os.path.exists(file):
+            os.remove(file)
     
 ################################################################################
 
+def hetfa_codes(gt, ref_base, alt_base, called):
+    """
+    The hetfa base for each site: ref or alt for homozygotes, the IUPAC code 
+    for heterozygotes and N for sites that can not be called
+    """
+    genotype=gt.sum(axis=1)
+    codes=np.where(genotype==0, ref_base, alt_base)
+    het=called&(genotype==1)
+    codes[het]=HETFA_CODES[ref_base[het], alt_base[het]]
+    if (codes[het]==0).any():
+        raise Exception("No hetfa code for "+chr(ref_base[het][codes[het]==0][0])+"/"+chr(alt_base[het][codes[het]==0][0]))
+    codes[~called]=ord("N")
+    return codes
+
+################################################################################
+
+
+def output_chrom(options):
+    """
+    Output one chromosome. Returns the files written. 
+    """
+    if options["haplotypes"]:
+        return output_fastas(options)
+    else:
+        return output_hetfa(options)
+
+################################################################################
+
+def output_chrom_job(options):
+    """
+    Output one chromosome in a worker process. Returns the files written and 
+    the error, if there was one, rather than raising it.
+    """
+    try:
+        return output_chrom(options), None
+    except Exception as err:
+        return [], str(err)
+
+################################################################################
+
+def output_genome(options):
+    """
+    Output every chromosome in the reference, in parallel. Each chromosome is
+    written to out.chrom and then, unless we want separate files, appended to
+    the output in reference order. 
+    """
+    jobs=[]
+    for chrom in [x[0] for x in gdc.read_fai(options["ref"])]:
+        job=dict(options)
+        job.update({"chrom":chrom, "region":chrom, "out":options["out"]+"."+chrom})
+        jobs.append(job)
+
+    #Build the mask index once, rather than in every worker
+    if options["mask"]:
+        gdc.MaskIndex(options["mask"])
+
+    pool=multiprocessing.Pool(options["processes"])
+    results=pool.map(output_chrom_job, jobs)
+    pool.close()
+
+    failed=[]
+    outs={}
+    for job, (files, error) in zip(jobs, results):
+        if error:
+            print("Chromosome "+job["chrom"]+" failed: "+error, file=sys.stderr)
+            failed.append(job["chrom"])
+            continue
+        print("Chromosome "+job["chrom"]+" done", file=sys.stderr)
+        if options["separate"]:
+            continue
+        #Outputs are bgzipped or plain text, so can just be concatenated. 
+        for chrom_file in files:
+            genome_file=options["out"]+chrom_file[len(job["out"]):]
+            if genome_file not in outs:
+                outs[genome_file]=open(genome_file, "wb")
+            part=open(chrom_file, "rb")
+            shutil.copyfileobj(part, outs[genome_file])
+            part.close()
+            os.remove(chrom_file)
+    [out.close() for out in outs.values()]
+
+    if failed:
+        raise Exception("Failed on chromosomes "+", ".join(failed))
+
+################################################################################
 
 def main(options):
     """
     Iterate over the vcf and output one fasta file for each chromosome. 
     """
-    if options["haploid"]:
-        output_fastas(options)
+    if options["chrom"]:
+        output_chrom(options)
     else:
-        output_hetfa(options)
+        output_genome(options)
         
     
 ################################################################################